@@ -1,3 +1,18 @@
 #!/bin/bash
 
-celery -A mysite worker -l info -Q periodic_queue -n periodic_queue@%h
+# One worker per lane, see LANES in mysite/celery.py.
+celery -A mysite worker -l info -Q order_queue -n order_queue@%h \
+    -c "${ORDER_CONCURRENCY:-4}" --prefetch-multiplier=1 &
+celery -A mysite worker -l info -Q notify_queue -n notify_queue@%h \
+    -c "${NOTIFY_CONCURRENCY:-2}" --prefetch-multiplier=4 &
+celery -A mysite worker -l info -Q bulk_queue -n bulk_queue@%h \
+    -c "${BULK_CONCURRENCY:-2}" --prefetch-multiplier=1 &
+celery -A mysite worker -l info -Q periodic_queue -n periodic_queue@%h \
+    -c "${PERIODIC_CONCURRENCY:-1}" --prefetch-multiplier=1 &
+
+# Scheduler for the periodic tasks (daily report, reservation sweeper).
+celery -A mysite beat -l info &
+
+# Stop the container as soon as one of the lanes dies.
+wait -n
+exit $?
@@ -9,5 +9,25 @@ done &&
 python manage.py loaddata product_demo
 python manage.py loaddata shop_demo
 
+# The uwsgi workers and the celery container all append to /app/log/mysite.log
+# (shared volume), only this loop rotates it. Their WatchedFileHandler reopens
+# the file after it is moved, so rotation is safe with any number of writers.
+mkdir -p /app/log
+cat > /tmp/logrotate.conf <<EOF
+/app/log/mysite.log {
+    daily
+    maxsize ${APP_LOG_MAX_BYTES:-52428800}
+    rotate ${APP_LOG_BACKUP_COUNT:-14}
+    dateext
+    dateformat .%Y-%m-%d-%s
+    missingok
+    notifempty
+}
+EOF
+while true; do
+  logrotate -s /tmp/logrotate.status /tmp/logrotate.conf
+  sleep 300
+done &
+
 #python manage.py runserver 0.0.0.0:8000
 uwsgi --ini /uwsgi/uwsgi.ini
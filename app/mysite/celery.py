@@ -1,8 +1,14 @@
 from __future__ import absolute_import
 import os
+import time
+import logging
 from celery import Celery
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from kombu import Exchange, Queue
 from django.conf import settings
 
+from mysite.libs.memprofile import MemorySample
+
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
@@ -12,3 +18,130 @@ app = Celery('mysite')
 # pickle the object when using Windows.
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+timing_logger = logging.getLogger('mysite.celery.timing')
+
+
+# Queue topology. Every lane is consumed by its own worker (see
+# celery-entrypoint.sh), so bulk work and reports never take the prefetch
+# slots or processes of the latency sensitive order/stock tasks.
+ORDER_QUEUE = 'order_queue'          # latency sensitive: orders, stock
+NOTIFY_QUEUE = 'notify_queue'        # latency sensitive: notifications
+BULK_QUEUE = 'bulk_queue'            # big batches: bulk cancel, imports
+PERIODIC_QUEUE = 'periodic_queue'    # scheduled reports
+
+MAX_PRIORITY = 10
+DEFAULT_PRIORITY = MAX_PRIORITY // 2
+
+
+def _lane(name, priority=True):
+    # periodic_queue already exists on the broker without x-max-priority,
+    # redeclaring it with other arguments would fail. So the queue arguments
+    # are set here only, task_queue_max_priority would add x-max-priority to
+    # every queue.
+    arguments = {'x-max-priority': MAX_PRIORITY} if priority else None
+    return Queue(name, Exchange(name, type='direct'), routing_key=name,
+                 queue_arguments=arguments)
+
+
+# Per lane worker settings, mirrored by celery-entrypoint.sh.
+#   prefetch: 1 for long or latency sensitive tasks, so one slow task can not
+#   hold messages other processes could run.
+#   acks_late: tasks of the lane are idempotent, a lost worker means redelivery.
+LANES = {
+    ORDER_QUEUE: {'concurrency': 4, 'prefetch': 1, 'acks_late': True},
+    NOTIFY_QUEUE: {'concurrency': 2, 'prefetch': 4, 'acks_late': False},
+    BULK_QUEUE: {'concurrency': 2, 'prefetch': 1, 'acks_late': True},
+    PERIODIC_QUEUE: {'concurrency': 1, 'prefetch': 1, 'acks_late': False},
+}
+
+# Celery 4.1 has no default priority setting, the routes carry it. Messages
+# without one (unrouted tasks) get the lowest priority.
+TASK_ROUTES = {
+    'backfill_restocked_products': {'queue': ORDER_QUEUE,
+                                    'priority': DEFAULT_PRIORITY},
+    'expire_reservations': {'queue': ORDER_QUEUE,
+                            'priority': DEFAULT_PRIORITY},
+    'bulk_cancel_orders': {'queue': BULK_QUEUE, 'priority': DEFAULT_PRIORITY},
+    'purge_idempotency_keys': {'queue': BULK_QUEUE,
+                               'priority': DEFAULT_PRIORITY},
+    # Both read the order snapshot (shopper.analytics), which stays warm in
+    # the single process of the periodic lane.
+    'create_daily_report': {'queue': PERIODIC_QUEUE},
+    'refresh_top_products': {'queue': PERIODIC_QUEUE},
+}
+
+app.conf.update(
+    task_queues=[
+        _lane(ORDER_QUEUE),
+        _lane(NOTIFY_QUEUE),
+        _lane(BULK_QUEUE),
+        _lane(PERIODIC_QUEUE, priority=False),
+    ],
+    task_routes=TASK_ROUTES,
+    # Unknown tasks should not compete with orders.
+    task_default_queue=BULK_QUEUE,
+    worker_prefetch_multiplier=1,
+    task_reject_on_worker_lost=True,
+    task_annotations={
+        name: {'acks_late': LANES[route['queue']]['acks_late']}
+        for name, route in TASK_ROUTES.items()
+    },
+)
+
+
+# Instrumentation: time spent waiting in the queue vs executing, per task.
+# The publish time travels in the message headers, so the wait includes
+# any clock skew between the publishing host and the worker.
+_started_at = {}
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    _started_at[task_id] = time.time()
+
+
+@task_postrun.connect
+def record_task_timing(task_id=None, task=None, state=None, **kwargs):
+    started_at = _started_at.pop(task_id, None)
+    if started_at is None:
+        return
+
+    published_at = task.request.get('published_at')
+    delivery_info = task.request.get('delivery_info') or {}
+    timing_logger.info(
+        f'{task.name} {state}',
+        extra={
+            'task': task.name,
+            'task_id': task_id,
+            'queue': delivery_info.get('routing_key'),
+            'state': state,
+            'wait_ms': round((started_at - published_at) * 1000, 1)
+            if published_at else None,
+            'run_ms': round((time.time() - started_at) * 1000, 1),
+        })
+
+
+# Memory sampling, see mysite.libs.memprofile. A prefork child runs one task
+# at a time, tasks are keyed by id all the same.
+_memory_samples = {}
+
+
+@task_prerun.connect
+def start_memory_sample(task_id=None, **kwargs):
+    sample = MemorySample.maybe_start('task')
+    if sample is not None:
+        _memory_samples[task_id] = sample
+
+
+@task_postrun.connect
+def stop_memory_sample(task_id=None, task=None, state=None, **kwargs):
+    sample = _memory_samples.pop(task_id, None)
+    if sample is not None:
+        sample.stop(task.name, task_id=task_id, state=state)
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 """Schedules define the intervals at which periodic tasks run."""
 from __future__ import absolute_import, unicode_literals
+import json
 from datetime import datetime
 from celery.schedules import crontab, cronfield
 from celery.utils.time import ffwd
 from celery.utils.collections import AttributeDict
 from bisect import bisect, bisect_left
+from django.db import connections
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
 
 
 CRON_REPR = '''\
@@ -189,3 +193,44 @@ class ExtendedCrontab(crontab):
                 super(crontab, self).__eq__(other)
             )
         return NotImplemented
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Paginator which takes the row count from the Postgres planner statistics
+    (pg_class.reltuples, or the EXPLAIN estimate for a filtered queryset)
+    instead of an exact COUNT(*), once the estimate is above
+    `exact_count_limit`.
+    '''
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        estimate = self._estimate_count()
+        if estimate is None or estimate < self.exact_count_limit:
+            return super(EstimatedCountPaginator, self).count
+        return estimate
+
+    def _estimate_count(self):
+        queryset = self.object_list
+        if not hasattr(queryset, 'query'):
+            return None
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        with connection.cursor() as cursor:
+            if not queryset.query.where:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                    [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+                return row[0] if row else None
+
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
@@ -0,0 +1,142 @@
+"""Logging building blocks used by ``settings.LOGGING``."""
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from django.utils.module_loading import import_string
+
+
+# Attributes every LogRecord carries. Anything else was passed via `extra=`
+# and ends up as a top level key in the JSON output.
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | \
+    {'message', 'asctime'}
+_exc_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per line, so log files can be shipped and queried
+    without regex parsing.
+    '''
+
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+        }
+        for key, val in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key not in payload:
+                payload[key] = val
+
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc'] = record.exc_text
+        if record.stack_info:
+            payload['stack'] = record.stack_info
+
+        return json.dumps(payload, default=str)
+
+
+class SqlSampleFilter(logging.Filter):
+    '''
+    Sample django.db.backends records and cap them per second. Queries
+    slower than `slow_ms` always pass, those are the ones worth reading.
+    '''
+
+    def __init__(self, rate=0.01, per_second=10, slow_ms=200):
+        super(SqlSampleFilter, self).__init__()
+        self.rate = float(rate)
+        self.per_second = int(per_second)
+        self.slow = float(slow_ms) / 1000
+        self._window = 0
+        self._count = 0
+
+    def filter(self, record):
+        duration = getattr(record, 'duration', None)
+        if duration is not None and duration >= self.slow:
+            return True
+
+        if random.random() >= self.rate:
+            return False
+
+        now = int(time.monotonic())
+        if now != self._window:
+            self._window = now
+            self._count = 0
+        self._count += 1
+        return self._count <= self.per_second
+
+
+class QueueListenerHandler(QueueHandler):
+    '''
+    Hand records to a background QueueListener which owns the real handler
+    (`target`, a dotted path built with the remaining kwargs). The calling
+    thread only merges the message args and enqueues, it never formats or
+    touches the disk. When the queue is full the record is dropped rather
+    than blocking the request.
+
+    uwsgi forks the workers after the app is loaded and threads do not
+    survive a fork, so the listener is started lazily in each process.
+    '''
+
+    def __init__(self, target, queue_size=10000, **target_kwargs):
+        self.queue_size = queue_size
+        super(QueueListenerHandler, self).__init__(queue.Queue(queue_size))
+        self.target = import_string(target)(**target_kwargs)
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        # Formatting happens in the listener thread.
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Render what may change before the listener gets to the record,
+        # but leave the formatting itself to the target handler.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = \
+                    _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # The queue inherited from the parent may hold records and locks
+            # owned by a thread that no longer exists.
+            self.queue = queue.Queue(self.queue_size)
+            self._listener = QueueListener(self.queue, self.target,
+                                           respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def close(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+        self.target.close()
+        super(QueueListenerHandler, self).close()
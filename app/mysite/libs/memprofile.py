@@ -0,0 +1,157 @@
+"""
+Opt-in memory sampling of requests and celery tasks.
+
+uwsgi recycles a worker as soon as its RSS passes `reload-on-rss`. To find
+what pushes workers there, a fraction (`MEMPROFILE['SAMPLE_RATE']`) of the
+requests and tasks run under tracemalloc. Each sample logs its peak Python
+allocation and RSS growth to the 'mysite.memprofile' logger. Outliers also
+log their top allocating call sites. `manage.py memory_report` aggregates
+the records per endpoint/task from the JSON log files.
+
+tracemalloc only runs while a sample is taken, so unsampled requests pay
+nothing but a random() call.
+"""
+import os
+import random
+import logging
+import resource
+import tracemalloc
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+logger = logging.getLogger('mysite.memprofile')
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# Allocations of the profiler itself, not worth reporting.
+_IGNORED_FRAMES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def rss_bytes():
+    '''
+    Current resident set size, what uwsgi's reload-on-rss looks at. Falls back
+    to the peak RSS where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _kb(size):
+    return round(size / 1024, 1)
+
+
+class MemorySample(object):
+    '''
+    Traces the allocations between start() and stop().
+
+        sample = MemorySample.maybe_start('task')
+        ...
+        if sample is not None:
+            sample.stop('shopper.tasks.create_daily_report')
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.rss_before = None
+
+    @classmethod
+    def maybe_start(cls, kind):
+        '''
+        Start a sample for `SAMPLE_RATE` of the calls, None otherwise. Also
+        None when tracemalloc is already running, e.g. a task run eagerly
+        inside a sampled request, since the peak can not be split.
+        '''
+        rate = settings.MEMPROFILE['SAMPLE_RATE']
+        if rate <= 0 or random.random() >= rate or tracemalloc.is_tracing():
+            return None
+        return cls(kind).start()
+
+    def start(self):
+        self.rss_before = rss_bytes()
+        tracemalloc.start(settings.MEMPROFILE['FRAMES'])
+        return self
+
+    def stop(self, name, **extra):
+        '''
+        Stop tracing and log the sample under `name` (endpoint or task).
+        '''
+        conf = settings.MEMPROFILE
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            rss = rss_bytes()
+            outlier = peak >= conf['OUTLIER_KB'] * 1024
+            top = self._top_call_sites(conf['TOP']) if outlier else None
+        finally:
+            tracemalloc.stop()
+
+        extra.update({
+            'memprofile': self.kind,
+            'endpoint': name,
+            'peak_kb': _kb(peak),
+            'retained_kb': _kb(current),
+            'rss_kb': _kb(rss),
+            'rss_delta_kb': _kb(rss - self.rss_before),
+            'rss_limit_kb': conf['RSS_LIMIT_MB'] * 1024,
+        })
+        if top is None:
+            logger.info(f'{self.kind} {name} peak {_kb(peak)} KB', extra=extra)
+        else:
+            extra['top'] = top
+            logger.warning(f'{self.kind} {name} peak {_kb(peak)} KB',
+                           extra=extra)
+        return extra
+
+    @staticmethod
+    def _top_call_sites(limit):
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED_FRAMES)
+        return [
+            {
+                'site': f'{stat.traceback[0].filename}:'
+                        f'{stat.traceback[0].lineno}',
+                'size_kb': _kb(stat.size),
+                'count': stat.count,
+            }
+            for stat in snapshot.statistics('lineno')[:limit]
+        ]
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return f'{request.method} <unresolved>'
+    return f'{request.method} {match.view_name or match._func_path}'
+
+
+class MemoryProfileMiddleware(object):
+    '''
+    Samples whole requests, so keep it first in MIDDLEWARE. Responses are
+    rendered inside the middleware chain, the serialization of large list
+    responses is part of the sample; streamed content is not.
+    '''
+
+    def __init__(self, get_response):
+        if settings.MEMPROFILE['SAMPLE_RATE'] <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample = MemorySample.maybe_start('request')
+        if sample is None:
+            return self.get_response(request)
+
+        status = None
+        try:
+            response = self.get_response(request)
+            status = response.status_code
+        finally:
+            sample.stop(endpoint_name(request), status=status)
+        return response
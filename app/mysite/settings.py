@@ -10,7 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
-import os, datetime
+import os
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -45,6 +45,8 @@ START_APPS = [
 INSTALLED_APPS += START_APPS
 
 MIDDLEWARE = [
+    # Only active when MEMPROFILE['SAMPLE_RATE'] > 0.
+    'mysite.libs.memprofile.MemoryProfileMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -96,6 +98,17 @@ DATABASES = {
 }
 
 
+# Shared between the uwsgi workers and the celery workers.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.getenv('MEMCACHED_LOCATION', '127.0.0.1:11211'),
+        # gets/cas for the order admission token buckets.
+        'OPTIONS': {'cache_cas': True},
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -140,7 +153,14 @@ STATIC_URL = '/static/'
 # STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 LOG_PATH = '/app/log/'
-LOG_FILENAME = f'{datetime.datetime.now().strftime("%Y-%m-%d")}.log'
+# Every uwsgi worker and celery process appends to the same file, so none of
+# them may rotate it: logrotate does (see dev-entrypoint.sh, by date and by
+# APP_LOG_MAX_BYTES, keeping APP_LOG_BACKUP_COUNT files) and the
+# WatchedFileHandler of each process reopens the file once it is moved.
+LOG_FILENAME = 'mysite.log'
+
+# Every handler below is a QueueListenerHandler: request threads only
+# enqueue records, a background thread formats and writes them.
 LOGGING = {
     'version': 1,
    'disable_existing_loggers': False,
@@ -148,17 +168,32 @@ LOGGING = {
        'base': {
            'format': '%(asctime)s %(levelname)-8s %(name)-10s %(message)s',
        },
+       'json': {
+           '()': 'mysite.libs.logutils.JsonFormatter',
+       },
+   },
+   'filters': {
+       # SQL is only logged with DEBUG on. Keep a sample of it plus every
+       # query slower than `slow_ms`.
+       'sql_sample': {
+           '()': 'mysite.libs.logutils.SqlSampleFilter',
+           'rate': float(os.getenv('APP_SQL_LOG_SAMPLE_RATE', 0.01)),
+           'per_second': int(os.getenv('APP_SQL_LOG_PER_SECOND', 10)),
+           'slow_ms': int(os.getenv('APP_SQL_LOG_SLOW_MS', 200)),
+       },
    },
    'handlers': {
        'console': {
-           'class': 'logging.StreamHandler',
+           'class': 'mysite.libs.logutils.QueueListenerHandler',
+           'target': 'logging.StreamHandler',
            'formatter': 'base',
        },
        'file': {
-           'class': 'logging.handlers.RotatingFileHandler',
+           'class': 'mysite.libs.logutils.QueueListenerHandler',
+           'target': 'logging.handlers.WatchedFileHandler',
            'filename': f'{LOG_PATH}{LOG_FILENAME}',
-           'backupCount': 3,
-           'formatter': 'base',
+           'delay': True,
+           'formatter': 'json',
        }
    },
    'loggers': {
@@ -179,13 +214,65 @@ LOGGING = {
            'handlers': ['console'],
            'propagate': True,
        },
+       # Project loggers, e.g. the celery task timing in mysite.celery.
+       'mysite': {
+           'handlers': ['file'],
+           'level': os.getenv('APP_LOG_LEVEL', 'DEBUG'),
+           'propagate': False,
+       },
+       'shopper': {
+           'handlers': ['file'],
+           'level': os.getenv('APP_LOG_LEVEL', 'DEBUG'),
+           'propagate': False,
+       },
        'django.db.backends': {
            'handlers': ['console'],
+           # On the logger, not the handler, so that the records propagated
+           # to the 'django' file handler are sampled as well.
+           'filters': ['sql_sample'],
            'propagate': True,
        }
    },
 }
 
+# Seconds an unpaid (PAYMENT_PENDING) order keeps its stock reserved. Can be
+# overridden per shop and per product (reservation_ttl).
+ORDER_RESERVATION_TTL = int(os.getenv('ORDER_RESERVATION_TTL', 15 * 60))
+RESERVATION_SWEEP_BATCH = int(os.getenv('RESERVATION_SWEEP_BATCH', 500))
+
+# Idempotency-Key support (shopper.utils.idempotent), in seconds.
+# TTL: how long a response is replayed. WAIT: how long a concurrent duplicate
+# waits for the first request. LOCK_TIMEOUT: after which an unfinished key is
+# considered abandoned.
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 2))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+
+# Admission control on order creation (shopper.utils.admission_control).
+# Rates are orders per second, bursts the bucket sizes. MAX_IN_FLIGHT is
+# shared by all uwsgi workers, keep it below `processes` so reads still get
+# a worker when orders spike.
+ORDER_ADMISSION = {
+    'CUSTOMER_RATE': float(os.getenv('ORDER_CUSTOMER_RATE', 1)),
+    'CUSTOMER_BURST': int(os.getenv('ORDER_CUSTOMER_BURST', 5)),
+    'PRODUCT_RATE': float(os.getenv('ORDER_PRODUCT_RATE', 50)),
+    'PRODUCT_BURST': int(os.getenv('ORDER_PRODUCT_BURST', 100)),
+    'MAX_IN_FLIGHT': int(os.getenv('ORDER_MAX_IN_FLIGHT', 8)),
+    'RETRY_AFTER': int(os.getenv('ORDER_RETRY_AFTER', 1)),
+}
+
+# Memory sampling of requests and celery tasks (mysite.libs.memprofile),
+# off unless SAMPLE_RATE > 0. Samples with a tracemalloc peak above
+# OUTLIER_KB log their TOP allocating lines, FRAMES deep tracebacks are kept
+# while tracing. RSS_LIMIT_MB mirrors reload-on-rss in conf.d/uwsgi.ini.
+MEMPROFILE = {
+    'SAMPLE_RATE': float(os.getenv('APP_MEMPROFILE_RATE', 0)),
+    'OUTLIER_KB': int(os.getenv('APP_MEMPROFILE_OUTLIER_KB', 8 * 1024)),
+    'TOP': int(os.getenv('APP_MEMPROFILE_TOP', 10)),
+    'FRAMES': int(os.getenv('APP_MEMPROFILE_FRAMES', 1)),
+    'RSS_LIMIT_MB': 96,
+}
+
 EMAIL_HOST = os.environ.get('EMAIL_HOST')
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 SERVER_EMAIL = EMAIL_HOST_USER
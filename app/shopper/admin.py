@@ -1,24 +1,73 @@
 from django.contrib import admin
 
-from shopper.models import Product, Order, Customer
+from mysite.libs.classes import EstimatedCountPaginator
+from shopper.models import Product, Order, Customer, Shop
 # Register your models here.
 
 
+class ShopFilter(admin.SimpleListFilter):
+    '''
+    Lookups come from the small Shop table instead of a DISTINCT over the
+    filtered model.
+    '''
+    title = 'shop'
+    parameter_name = 'shop_id'
+
+    def lookups(self, request, model_admin):
+        shop_ids = Shop.objects.order_by('shop_id').values_list('shop_id',
+                                                                 flat=True)
+        return [(shop_id, shop_id) for shop_id in shop_ids]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(shop_id=self.value())
+        return queryset
+
+
 class ProductAdmin(admin.ModelAdmin):
     list_display = ['product_id', 'stock_pcs', 'price', 'shop_id', 'vip']
     readonly_fields = ['product_id']
     ordering = ['product_id', 'shop_id']
+    # Used by the order admin autocomplete, see get_search_results().
+    search_fields = ['product_id']
+    list_filter = ['vip']
+    sortable_by = ['product_id']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        '''
+        Case sensitive prefix match, LIKE 'p12%' is served by the
+        product_id pattern index. '^product_id' would be istartswith, an
+        UPPER(product_id) LIKE that scans the whole table on each keystroke.
+        '''
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(product_id__startswith=search_term), False
 
 
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['order_id', 'product__product_id', 'qty', 'price',
+    list_display = ['order_id', 'product_code', 'qty', 'price',
                     'total_price', 'shop_id', 'created_at', 'status']
-    readonly_fields = ['order_id']
-    ordering = ['created_at']
+    list_select_related = ['product']
+    list_filter = ['status', ShopFilter, 'created_at']
+    readonly_fields = ['order_id', 'total_price', 'version']
+    autocomplete_fields = ['product']
+    # Only sort on indexed columns, anything else is a full table sort.
+    ordering = ['-created_at']
+    sortable_by = ['order_id', 'created_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def product_code(self, obj):
+        return obj.product.product_id
+    product_code.short_description = 'product id'
 
 
 class CustomerAdmin(admin.ModelAdmin):
-    list_display = ['customer_id, is_vip']
+    list_display = ['id', 'user', 'is_vip']
+    list_select_related = ['user']
 
 
 admin.site.register(Product, ProductAdmin)
@@ -0,0 +1,260 @@
+"""
+Columnar, in-memory snapshot of the orders for reports and dashboards.
+
+Instead of a bespoke aggregate query on the primary for every question, the
+orders are loaded once into NumPy arrays and kept up to date incrementally
+(by `created_at` and `updated_at` watermarks). Group-by, time-bucket and top-K questions are
+then answered with vectorized operations.
+
+    snapshot = get_snapshot()
+    snapshot.shop_totals()
+    snapshot.revenue_by_shop(start, end, bucket=3600)
+    snapshot.top_products(k=3, start=start, end=end)
+
+The snapshot is built in celery (see shopper.tasks), uwsgi workers must not
+import this module: NumPy alone would push them towards reload-on-as, and
+every worker would hold its own copy of the table.
+"""
+import time
+import datetime
+import itertools
+import threading
+
+import numpy as np
+from django.utils import timezone
+
+from shopper.models import Order
+
+
+def _epoch(dt):
+    return int(dt.timestamp())
+
+
+def _from_epoch(seconds):
+    return datetime.datetime.fromtimestamp(int(seconds), tz=timezone.utc)
+
+
+class OrderSnapshot(object):
+    '''
+    One array per column, row i of every array is the same order:
+
+        ids, created_at (epoch seconds), shop (code into `shops`),
+        product (Product pk), qty, price, status
+
+    refresh() reads the rows created since the last one, then the statuses
+    of the orders updated since the last one (cancel, expiry, restock
+    happen at any age). `created_at` and `updated_at` are set before the
+    writing transaction commits, so a row can become visible with a value
+    older than a watermark already passed: both reads go back `lag` to
+    catch those.
+
+    Only meant for celery workers, one snapshot holds the whole order table.
+    '''
+
+    CHUNK_SIZE = 10000
+
+    def __init__(self, lag=datetime.timedelta(minutes=5)):
+        self.lag = lag
+        self.ids = np.empty(0, np.int64)
+        self.created_at = np.empty(0, np.int64)
+        self.shop = np.empty(0, np.int32)
+        self.product = np.empty(0, np.int32)
+        self.qty = np.empty(0, np.int32)
+        self.price = np.empty(0, np.float64)
+        self.status = np.empty(0, np.int8)
+
+        self.shops = []
+        self._shop_codes = {}
+        self._id_order = np.empty(0, np.int64)
+        # Newest created_at loaded, newest updated_at seen.
+        self.watermark = None
+        self.status_watermark = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def refresh(self):
+        with self._lock:
+            initial = self.watermark is None
+            self._load_new_rows()
+            if not initial:
+                self._sync_statuses()
+            self.refreshed_at = time.monotonic()
+        return self
+
+    def _shop_code(self, shop_id):
+        code = self._shop_codes.get(shop_id)
+        if code is None:
+            code = self._shop_codes[shop_id] = len(self.shops)
+            self.shops.append(shop_id)
+        return code
+
+    def _chunk_columns(self, chunk):
+        return (
+            np.array([row[0] for row in chunk], np.int64),
+            np.array([_epoch(row[1]) for row in chunk], np.int64),
+            np.array([self._shop_code(row[2]) for row in chunk], np.int32),
+            np.array([row[3] for row in chunk], np.int32),
+            np.array([row[4] for row in chunk], np.int32),
+            np.array([row[5] for row in chunk], np.float64),
+            np.array([row[6] for row in chunk], np.int8),
+        )
+
+    def _load_new_rows(self):
+        query = Order.objects.order_by('created_at')
+        known = None
+        if self.watermark is not None:
+            since = self.watermark - self.lag
+            query = query.filter(created_at__gte=since)
+            known = self.ids[self.created_at >= _epoch(since)]
+        rows = query.values_list(
+            'id', 'created_at', 'shop_id', 'product_id', 'qty', 'price',
+            'status', 'updated_at').iterator(chunk_size=self.CHUNK_SIZE)
+
+        # Converted chunk by chunk, no list of the whole table is built.
+        parts = [[] for _ in range(7)]
+        watermark, status_watermark = self.watermark, self.status_watermark
+        while True:
+            chunk = list(itertools.islice(rows, self.CHUNK_SIZE))
+            if not chunk:
+                break
+            columns = self._chunk_columns(chunk)
+            fresh = np.ones(len(chunk), bool) if known is None \
+                else ~np.isin(columns[0], known)
+            for part, column in zip(parts, columns):
+                part.append(column[fresh])
+
+            watermark = chunk[-1][1]
+            latest = max(row[7] for row in chunk)
+            if status_watermark is None or latest > status_watermark:
+                status_watermark = latest
+
+        if not parts[0]:
+            return
+
+        self.ids, self.created_at, self.shop, self.product, self.qty, \
+            self.price, self.status = [
+                np.concatenate([current] + part) for current, part in zip(
+                    (self.ids, self.created_at, self.shop, self.product,
+                     self.qty, self.price, self.status), parts)
+            ]
+        self._id_order = np.argsort(self.ids, kind='mergesort')
+        self.watermark = watermark
+        if self.status_watermark is None:
+            # Rows loaded here already carry their current status.
+            self.status_watermark = status_watermark
+
+    def _sync_statuses(self):
+        if self.status_watermark is None or not len(self.ids):
+            return
+
+        rows = Order.objects.filter(
+            updated_at__gte=self.status_watermark - self.lag
+        ).values_list('id', 'status', 'updated_at')
+        changed = []
+        status_watermark = self.status_watermark
+        for order_id, status, updated_at in rows.iterator(
+                chunk_size=self.CHUNK_SIZE):
+            changed.append((order_id, status))
+            status_watermark = max(status_watermark, updated_at)
+        if not changed:
+            return
+
+        changed = np.array(changed, np.int64)
+        sorted_ids = self.ids[self._id_order]
+        pos = np.searchsorted(sorted_ids, changed[:, 0])
+        pos = np.minimum(pos, len(sorted_ids) - 1)
+        found = sorted_ids[pos] == changed[:, 0]
+        self.status[self._id_order[pos[found]]] = changed[found, 1]
+        self.status_watermark = status_watermark
+
+    def _mask(self, start=None, end=None, statuses=Order.ACTIVE_STATUSES):
+        mask = np.isin(self.status, statuses)
+        if start is not None:
+            mask &= self.created_at >= _epoch(start)
+        if end is not None:
+            mask &= self.created_at < _epoch(end)
+        return mask
+
+    def shop_totals(self, start=None, end=None):
+        '''
+        Per shop order count, sold qty and revenue.
+
+        :return: {shop_id: {'total_order_count', 'total_qty',
+                            'total_order_price'}}
+        '''
+        mask = self._mask(start, end)
+        shop = self.shop[mask]
+        size = len(self.shops)
+
+        count = np.bincount(shop, minlength=size)
+        qty = np.bincount(shop, weights=self.qty[mask], minlength=size)
+        revenue = np.bincount(
+            shop, weights=self.qty[mask] * self.price[mask], minlength=size)
+
+        return {
+            self.shops[code]: {
+                'total_order_count': int(count[code]),
+                'total_qty': int(qty[code]),
+                'total_order_price': float(revenue[code]),
+            }
+            for code in np.flatnonzero(count)
+        }
+
+    def revenue_by_shop(self, start, end, bucket=3600):
+        '''
+        Revenue per shop per `bucket` seconds within [start, end).
+
+        :return: [{'shop_id', 'bucket_start', 'revenue'}], empty cells left out
+        '''
+        mask = self._mask(start, end)
+        n_buckets = max(1, -(-(_epoch(end) - _epoch(start)) // bucket))
+
+        buckets = (self.created_at[mask] - _epoch(start)) // bucket
+        cells = self.shop[mask].astype(np.int64) * n_buckets + buckets
+        revenue = np.bincount(
+            cells, weights=self.qty[mask] * self.price[mask],
+            minlength=len(self.shops) * n_buckets)
+
+        return [
+            {
+                'shop_id': self.shops[cell // n_buckets],
+                'bucket_start': _from_epoch(
+                    _epoch(start) + (cell % n_buckets) * bucket),
+                'revenue': float(revenue[cell]),
+            }
+            for cell in np.flatnonzero(revenue)
+        ]
+
+    def top_products(self, k=3, start=None, end=None, by='qty'):
+        '''
+        The `k` products with the highest total qty (or revenue, by='revenue').
+
+        :return: [(Product pk, total)], highest first
+        '''
+        mask = self._mask(start, end)
+        weights = self.qty[mask] if by == 'qty' \
+            else self.qty[mask] * self.price[mask]
+        totals = np.bincount(self.product[mask], weights=weights)
+
+        k = min(k, np.count_nonzero(totals))
+        if k <= 0:
+            return []
+        top = np.argpartition(-totals, k - 1)[:k]
+        top = top[np.argsort(-totals[top], kind='mergesort')]
+        return [(int(product), float(totals[product])) for product in top]
+
+
+_snapshot = OrderSnapshot()
+
+
+def get_snapshot(max_age=60):
+    '''
+    The process wide snapshot, refreshed when older than `max_age` seconds.
+    '''
+    refreshed_at = _snapshot.refreshed_at
+    if refreshed_at is None or time.monotonic() - refreshed_at > max_age:
+        _snapshot.refresh()
+    return _snapshot
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ShopperConfig(AppConfig):
     name = 'shopper'
+
+    def ready(self):
+        from shopper.models import install_order_total_trigger
+        post_migrate.connect(install_order_total_trigger, sender=self)
@@ -0,0 +1,285 @@
+"""
+Bulk catalog and stock import.
+
+The file is streamed into a temporary staging table with Postgres COPY and
+upserted into shopper_product with a single statement, so no Product.save()
+and no post_save receiver runs per row. The statement also returns the
+products which went from zero to positive stock, the caller runs the
+restock backfill for those only.
+"""
+import io
+import re
+import csv
+import json
+
+import psycopg2
+from django.db import connection, transaction
+
+
+CATALOG_COLUMNS = ('product_id', 'stock_pcs', 'price', 'shop_id', 'vip')
+CATALOG_FORMATS = ('csv', 'ndjson')
+
+_COLUMN_TYPES = {
+    'product_id': 'varchar(255) NOT NULL',
+    'stock_pcs': 'integer',
+    'price': 'double precision',
+    'shop_id': 'varchar(255)',
+    'vip': 'boolean',
+}
+# Model defaults, for new products when the file lacks the column.
+_INSERT_DEFAULTS = {
+    'stock_pcs': '0',
+    'price': '0',
+    'shop_id': 'NULL',
+    'vip': 'false',
+}
+
+# A single statement: both data-modifying CTEs run even though only the
+# UPDATE is read, and they see the same snapshot as `prev`.
+_UPSERT_SQL = '''
+WITH staged AS (
+    SELECT DISTINCT ON (product_id) {columns}
+    FROM catalog_staging
+    ORDER BY product_id, line_no DESC
+),
+prev AS (
+    SELECT p.id, p.stock_pcs
+    FROM shopper_product p JOIN staged s ON s.product_id = p.product_id
+),
+updated AS (
+    {update_sql}
+),
+inserted AS (
+    INSERT INTO shopper_product ({all_columns})
+    SELECT {insert_values}
+    FROM staged s LEFT JOIN shopper_product p ON p.product_id = s.product_id
+    WHERE p.id IS NULL
+    ON CONFLICT (product_id) DO NOTHING
+)
+SELECT u.id
+FROM updated u JOIN prev ON prev.id = u.id
+WHERE prev.stock_pcs <= 0 AND u.stock_pcs > 0
+'''
+
+
+class CatalogError(ValueError):
+    pass
+
+
+def guess_format(filename):
+    if filename.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return 'csv'
+
+
+def _read_csv(fileobj):
+    reader = csv.reader(fileobj)
+    try:
+        header = [column.strip() for column in next(reader)]
+    except StopIteration:
+        raise CatalogError('empty catalog file')
+
+    def rows():
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise CatalogError(
+                    f'line {reader.line_num}: expected {len(header)} '
+                    f'columns, got {len(row)}')
+            yield reader.line_num, row
+
+    return header, rows()
+
+
+def _ndjson_value(val):
+    if isinstance(val, bool):
+        return 'true' if val else 'false'
+    return val
+
+
+def _ndjson_record(line_no, line):
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise CatalogError(f'line {line_no}: invalid JSON, {e}')
+    if not isinstance(record, dict):
+        raise CatalogError(f'line {line_no}: expected a JSON object')
+    return record
+
+
+def _read_ndjson(fileobj):
+    # The first record sets the columns, later records may leave some out
+    # but not add any: the COPY column list is fixed before they are read.
+    lines = ((line_no, line) for line_no, line in enumerate(fileobj, 1)
+             if line.strip())
+    try:
+        first_line = next(lines)
+    except StopIteration:
+        raise CatalogError('empty catalog file')
+    first = _ndjson_record(*first_line)
+    header = list(first)
+
+    def rows():
+        line_no, record = first_line[0], first
+        while True:
+            yield line_no, [_ndjson_value(record.get(column))
+                            for column in header]
+            try:
+                line_no, line = next(lines)
+            except StopIteration:
+                return
+            record = _ndjson_record(line_no, line)
+            extra = set(record) - set(header)
+            if extra:
+                raise CatalogError(
+                    f'line {line_no}: columns not in the first record: '
+                    f'{", ".join(sorted(extra))}')
+
+    return header, rows()
+
+
+_READERS = {'csv': _read_csv, 'ndjson': _read_ndjson}
+
+
+def _csv_lines(rows, line_offsets):
+    '''
+    :param line_offsets: filled with (record number, file line number) each
+        time their distance changes (blank lines, multi-line records), to map
+        the record number in a COPY error back to the file, see _line_no().
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    offset = None
+    for record_no, (line_no, row) in enumerate(rows, 1):
+        if line_no - record_no != offset:
+            offset = line_no - record_no
+            line_offsets.append((record_no, line_no))
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+_COPY_LINE_RE = re.compile(r'COPY catalog_staging, line (\d+)')
+
+
+def _copy_error(e, line_offsets):
+    '''
+    CatalogError for a COPY failure, with the file line of the bad record.
+    '''
+    message = e.diag.message_primary or str(e).splitlines()[0]
+    match = _COPY_LINE_RE.search(e.diag.context or '')
+    if not match:
+        return CatalogError(message)
+
+    record_no = int(match.group(1))
+    start, line_no = next(
+        ((start, line_no) for start, line_no in reversed(line_offsets)
+         if start <= record_no), (record_no, record_no))
+    return CatalogError(f'line {line_no + record_no - start}: {message}')
+
+
+class _LineStream(object):
+    '''
+    File-like object for copy_expert(), reads from a line generator so the
+    catalog is never held in memory as a whole. psycopg2 would turn an error
+    raised from read() into QueryCanceled, a CatalogError of the reader ends
+    the data instead and is kept in `error`.
+    '''
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._pending = ''
+        self.error = None
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            try:
+                self._pending += next(self._lines)
+            except StopIteration:
+                break
+            except CatalogError as e:
+                self.error = e
+                self._pending = ''
+                return ''
+        if size < 0:
+            size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def import_catalog(fileobj, fmt='csv'):
+    '''
+    Upsert the products of a CSV (with header) or NDJSON catalog, keyed by
+    product_id. Empty or missing values keep the current value, or get the
+    model default for new products. When a product_id shows up more than
+    once the last line wins. NDJSON records can not have keys the first
+    record lacks.
+
+    :param fileobj: text file object
+    :return: {'rows': staged row count,
+              'restocked': pks of products whose stock went from 0 to > 0}
+    '''
+    if fmt not in _READERS:
+        raise CatalogError(f'unsupported format {fmt}')
+
+    header, rows = _READERS[fmt](fileobj)
+    if 'product_id' not in header:
+        raise CatalogError('product_id column is required')
+    duplicated = {column for column in header if header.count(column) > 1}
+    if duplicated:
+        raise CatalogError(
+            f'duplicate columns: {", ".join(sorted(duplicated))}')
+    unknown = set(header) - set(CATALOG_COLUMNS)
+    if unknown:
+        raise CatalogError(f'unknown columns: {", ".join(sorted(unknown))}')
+
+    updated = [column for column in header if column != 'product_id']
+    if updated:
+        update_sql = (
+            'UPDATE shopper_product p SET ' +
+            ', '.join(f'{column} = COALESCE(s.{column}, p.{column})'
+                      for column in updated) +
+            ' FROM staged s WHERE p.product_id = s.product_id'
+            ' RETURNING p.id, p.stock_pcs'
+        )
+    else:
+        update_sql = 'SELECT id, stock_pcs FROM prev'
+    insert_values = ['s.product_id'] + [
+        f'COALESCE(s.{column}, {_INSERT_DEFAULTS[column]})'
+        if column in header else _INSERT_DEFAULTS[column]
+        for column in CATALOG_COLUMNS[1:]
+    ]
+
+    staging_columns = ', '.join(
+        f'{column} {_COLUMN_TYPES[column]}' for column in header)
+    upsert_sql = _UPSERT_SQL.format(
+        columns=', '.join(header),
+        update_sql=update_sql,
+        all_columns=', '.join(CATALOG_COLUMNS),
+        insert_values=', '.join(insert_values),
+    )
+
+    line_offsets = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TEMP TABLE catalog_staging '
+            f'(line_no bigserial, {staging_columns}) ON COMMIT DROP')
+        stream = _LineStream(_csv_lines(rows, line_offsets))
+        try:
+            cursor.copy_expert(
+                f'COPY catalog_staging ({", ".join(header)}) '
+                f'FROM STDIN WITH (FORMAT csv)', stream)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            # Bad values (non numeric stock_pcs, missing product_id, ...).
+            # copy_expert is not wrapped by Django, these are psycopg2's.
+            raise _copy_error(e, line_offsets)
+        if stream.error is not None:
+            raise stream.error
+        staged = cursor.rowcount
+
+        cursor.execute(upsert_sql)
+        restocked = [row[0] for row in cursor.fetchall()]
+
+    return {'rows': staged, 'restocked': restocked}
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shopper.catalog import import_catalog, guess_format, CatalogError, \
+    CATALOG_FORMATS
+from shopper.models import backfill_restocked_orders
+from shopper.tasks import backfill_restocked_products
+
+
+class Command(BaseCommand):
+    help = 'Bulk import a product catalog (prices, stock_pcs, ...) from a ' \
+           'CSV or NDJSON file, then backfill orders of restocked products.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=CATALOG_FORMATS,
+                            help='Guessed from the file extension if omitted')
+        parser.add_argument('--async', dest='run_async', action='store_true',
+                            help='Leave the restock backfill to celery')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+
+        try:
+            with open(path, newline='', encoding='utf-8') as fileobj:
+                result = import_catalog(fileobj, fmt)
+        except CatalogError as e:
+            raise CommandError(str(e))
+
+        restocked = result['restocked']
+        if options['run_async']:
+            backfill_restocked_products.delay(restocked)
+        else:
+            for product_id in restocked:
+                backfill_restocked_orders(product_id)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result['rows']} rows, "
+            f"{len(restocked)} products back in stock"))
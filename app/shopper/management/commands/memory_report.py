@@ -0,0 +1,100 @@
+import glob
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Summarize the memory samples (mysite.libs.memprofile) found in ' \
+           'the JSON log files per endpoint and celery task, worst first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*',
+            help='Log files, the current and rotated mysite.log by default')
+        parser.add_argument('--kind', choices=('request', 'task'))
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Number of endpoints/tasks to show')
+        parser.add_argument('--sites', type=int, default=5,
+                            help='Top allocating call sites per endpoint')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or sorted(
+            glob.glob(f'{settings.LOG_PATH}{settings.LOG_FILENAME}*'))
+        if not paths:
+            raise CommandError('no log files found')
+
+        samples = defaultdict(list)
+        for record in self._records(paths):
+            if options['kind'] and record['memprofile'] != options['kind']:
+                continue
+            samples[record['endpoint']].append(record)
+        if not samples:
+            self.stdout.write('No memory samples, is APP_MEMPROFILE_RATE set?')
+            return
+
+        rows = [self._summarize(endpoint, records, options['sites'])
+                for endpoint, records in samples.items()]
+        rows.sort(key=lambda row: row['p95_peak_kb'], reverse=True)
+
+        limit_kb = settings.MEMPROFILE['RSS_LIMIT_MB'] * 1024
+        self.stdout.write(
+            f"{'endpoint':<50} {'samples':>7} {'p50 KB':>9} {'p95 KB':>9} "
+            f"{'max KB':>9} {'rss+ KB':>9} {'>limit':>6}")
+        for row in rows[:options['limit']]:
+            self.stdout.write(
+                f"{row['endpoint']:<50} {row['samples']:>7} "
+                f"{row['p50_peak_kb']:>9.0f} {row['p95_peak_kb']:>9.0f} "
+                f"{row['max_peak_kb']:>9.0f} {row['max_rss_delta_kb']:>9.0f} "
+                f"{row['over_limit']:>6}")
+            for site, size_kb in row['sites']:
+                self.stdout.write(f'    {size_kb:>9.0f} KB  {site}')
+
+        over = [row['endpoint'] for row in rows if row['over_limit']]
+        if over:
+            self.stdout.write(self.style.WARNING(
+                f'Left workers above {limit_kb / 1024:.0f} MB RSS '
+                f'(reload-on-rss): {", ".join(over)}'))
+
+    def _records(self, paths):
+        for path in paths:
+            with open(path, encoding='utf-8', errors='replace') as log_file:
+                for line in log_file:
+                    if '"memprofile"' not in line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'endpoint' in record and 'peak_kb' in record:
+                        yield record
+
+    @staticmethod
+    def _summarize(endpoint, records, n_sites):
+        peaks = [record['peak_kb'] for record in records]
+        # Call sites of the outliers, summed over the samples.
+        sites = defaultdict(float)
+        for record in records:
+            for site in record.get('top') or ():
+                sites[site['site']] += site['size_kb']
+
+        return {
+            'endpoint': endpoint,
+            'samples': len(records),
+            'p50_peak_kb': _percentile(peaks, 50),
+            'p95_peak_kb': _percentile(peaks, 95),
+            'max_peak_kb': max(peaks),
+            'max_rss_delta_kb': max(record['rss_delta_kb']
+                                    for record in records),
+            'over_limit': sum(record['rss_kb'] > record['rss_limit_kb']
+                              for record in records),
+            'sites': sorted(sites.items(), key=lambda item: item[1],
+                            reverse=True)[:n_sites],
+        }
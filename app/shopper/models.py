@@ -1,21 +1,41 @@
 import uuid
+import json
 import datetime
 
-from django.db import models
+from django.db import models, connection, connections
+from django.db.models import F
 from django.dispatch import receiver
 from django.db.models.signals import post_save
 from django.db import transaction as dtransaction
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.utils import timezone
 
 # Create your models here.
 
 
+class InvalidTransition(Exception):
+    pass
+
+
+class TransitionConflict(Exception):
+    pass
+
+
+# Order.ACTIVE_STATUSES (SUCCESS, PAYMENT_PENDING, NOT_IN_STOCK). Module level
+# for the partial index in Order.Meta, which can not see the class body.
+ACTIVE_ORDER_STATUSES = (1, 3, 4)
+
+
 class Product(models.Model):
     product_id = models.CharField(max_length=255, unique=True)
     stock_pcs = models.IntegerField(default=0)
     price = models.FloatField(default=0.0)
     shop_id = models.CharField(max_length=255, null=True, blank=True)
-    vip = models.BooleanField(default=False, index=True)
+    vip = models.BooleanField(default=False, db_index=True)
+    # Seconds an unpaid order keeps its stock, falls back to the shop's
+    # and then to settings.ORDER_RESERVATION_TTL.
+    reservation_ttl = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         db_table = 'shopper_product'
@@ -28,6 +48,23 @@ class Order(models.Model):
     PAYMENT_PENDING = 3
     NOT_IN_STOCK = 4
     CANCEL = 5
+    EXPIRED = 6
+
+    # The only status changes allowed, see transition().
+    STATUS_TRANSITIONS = {
+        PAYMENT_PENDING: (SUCCESS, FAIL, CANCEL, EXPIRED),
+        NOT_IN_STOCK: (PAYMENT_PENDING, FAIL, CANCEL),
+        SUCCESS: (CANCEL,),
+        FAIL: (),
+        CANCEL: (),
+        EXPIRED: (),
+    }
+
+    # Orders in these statuses hold stock, cancelling them gives it back.
+    STOCK_HOLDING_STATUSES = (SUCCESS, PAYMENT_PENDING)
+    CANCELLABLE_STATUSES = (SUCCESS, PAYMENT_PENDING, NOT_IN_STOCK)
+    # Orders counted in reports and statistics.
+    ACTIVE_STATUSES = ACTIVE_ORDER_STATUSES
 
     ORDER_STATUS_OPTIONS = (
         (SUCCESS, 'Success'),
@@ -35,16 +72,19 @@ class Order(models.Model):
         (PAYMENT_PENDING, 'Payment Pending'),
         (NOT_IN_STOCK, 'Not In Stock'),
         (CANCEL, 'Cancelled'),
+        (EXPIRED, 'Expired'),
     )
 
     order_id = models.CharField(max_length=255, null=True, blank=True,
                                 unique=True)
     product = models.ForeignKey(Product, related_name='orders',
-                                on_delete=models.CASCADE),
+                                on_delete=models.CASCADE)
     qty = models.IntegerField(default=0)
     price = models.FloatField(default=0)
 
-    # This filed is to make statistic routine more efficient
+    # This filed is to make statistic routine more efficient. Kept equal to
+    # qty * price by a trigger (install_order_total_trigger), so bulk_create,
+    # bulk_update and QuerySet.update() can not leave it stale.
     total_price = models.FloatField(blank=True, null=True)
 
     shop_id = models.CharField(max_length=255, null=True, blank=True)
@@ -54,13 +94,86 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     status = models.IntegerField(default=PAYMENT_PENDING,
                                  choices=ORDER_STATUS_OPTIONS)
+    # Bumped on every status change, for compare-and-swap updates.
+    version = models.IntegerField(default=0)
+    # Every write sets it, the set-based status UPDATEs below included. The
+    # order snapshot (shopper.analytics) re-reads changed statuses by it.
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Start of the stock reservation, the reservation TTL counts from here:
+    # the creation, or the promotion of a NOT_IN_STOCK order after a restock.
+    reserved_at = models.DateTimeField(default=timezone.now)
 
     def save(self, *args, **kwargs):
+        # The trigger writes the same value, this only keeps the instance in
+        # sync. After bulk writes re-read the orders to see their totals.
         self.total_price = self.qty * self.price
         super(Order, self).save(*args, **kwargs)
 
     class Meta:
         db_table = 'shopper_order'
+        # For the admin filters, the order list filters (filter_orders in
+        # views.py) and the range scans by date. All end with created_at, the
+        # lists are ordered by it.
+        indexes = [
+            models.Index(fields=['status', 'created_at'],
+                         name='order_status_created_idx'),
+            # The reservation sweep (expire_reservations).
+            models.Index(fields=['status', 'reserved_at'],
+                         name='order_status_reserved_idx'),
+            models.Index(fields=['shop_id', 'created_at'],
+                         name='order_shop_created_idx'),
+            models.Index(fields=['shop_id', 'status', 'created_at'],
+                         name='order_shop_status_created_idx'),
+            models.Index(fields=['product', 'created_at'],
+                         name='order_product_created_idx'),
+            # What shops mostly look at: their active orders by date.
+            models.Index(fields=['shop_id', 'created_at'],
+                         name='order_shop_active_idx',
+                         condition=models.Q(
+                             status__in=list(ACTIVE_ORDER_STATUSES))),
+        ]
+
+    def can_transition(self, status):
+        return status in self.STATUS_TRANSITIONS.get(self.status, ())
+
+    def transition(self, status, max_retries=3):
+        '''
+        Move the order to `status` with a compare-and-swap
+        UPDATE ... WHERE status = old AND version = v, no row lock is taken.
+        When another writer got there first the row is re-read and the
+        transition retried, as long as it is still a valid one.
+
+        :return: the status the order had before
+        '''
+        for _ in range(max_retries):
+            if not self.can_transition(status):
+                raise InvalidTransition(
+                    f'Order {self.order_id} can not go from '
+                    f'{self.get_status_display()} to '
+                    f'{dict(self.ORDER_STATUS_OPTIONS).get(status, status)}')
+
+            now = timezone.now()
+            changes = {'status': status, 'version': F('version') + 1,
+                       'updated_at': now}
+            if status == self.PAYMENT_PENDING:
+                # A promoted order gets the full TTL to pay.
+                changes['reserved_at'] = now
+            updated = Order.objects.filter(
+                pk=self.pk, status=self.status, version=self.version
+            ).update(**changes)
+            if updated:
+                prev_status = self.status
+                self.status = status
+                self.version += 1
+                if 'reserved_at' in changes:
+                    self.reserved_at = now
+                return prev_status
+
+            self.refresh_from_db(fields=['status', 'version'])
+
+        raise TransitionConflict(
+            f'Order {self.order_id} kept changing, gave up after '
+            f'{max_retries} tries')
 
     # For safety, we use custom order_id, not a serial number
     def __init__(self, *args, **kwargs):
@@ -79,32 +192,261 @@ class Customer(models.Model):
     is_vip = models.BooleanField(default=False)
 
 
+class IdempotencyKey(models.Model):
+    '''
+    Result of a request sent with an Idempotency-Key header, see
+    shopper.utils.idempotent. status_code stays null while it runs.
+    '''
+    key = models.CharField(max_length=64, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.IntegerField(null=True, blank=True)
+    response = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def as_record(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'status_code': self.status_code,
+            'data': json.loads(self.response) if self.response else None,
+            'created_at': self.created_at,
+        }
+
+
 class Shop(models.Model):
     shop_id = models.CharField(max_length=255, unique=True)
+    # Default reservation TTL for the products of the shop, in seconds.
+    reservation_ttl = models.PositiveIntegerField(null=True, blank=True)
 
 
-@receiver(post_save, sender=Product)
-def sync_order_status(sender, instance, created=False, *args, **kargs):
+def backfill_restocked_orders(product_id):
+    '''
+    Promote NOT_IN_STOCK orders of a product back to PAYMENT_PENDING, smallest
+    qty first, for as long as its stock lasts. Returns the promoted count.
 
-    # TODO: need use cache lock to prevent race condition
+    Each order is promoted in its own short transaction: the stock is taken
+    with a conditional UPDATE and the status moved with Order.transition(),
+    so a concurrent cancel just makes that one promotion roll back.
+    '''
+    promoted = 0
+    orders = Order.objects.filter(
+        product_id=product_id, status=Order.NOT_IN_STOCK
+    ).order_by('qty').only('id', 'order_id', 'qty', 'status', 'version')
 
-    if not created:
-        # Always sync order status with the product
-        if instance.stock_pcs > 0:
-            stock_pcs = instance.stock_pcs
+    for order in orders:
+        try:
             with dtransaction.atomic():
-                orders = instance.orders.filter(status=Order.NOT_IN_STOCK
-                        ).order_by('qty')
-                for order in orders:
-                    if order.qty <= instance.stock_pcs:
-                        order.status = Order.PAYMENT_PENDING
-                        order.save()
-                        stock_pcs -= order.qty
-                        # TODO: to notify the customer in-stock, need use websocket
-                    else:
-                        break
-
-                # Need to update new stock_pcs again?
-                if stock_pcs != instance.stock_pcs:
-                    Product.objects.filter(product_id=instance.product_id
-                        ).update(stock_pcs=stock_pcs)
+                taken = Product.objects.filter(
+                    pk=product_id, stock_pcs__gte=order.qty
+                ).update(stock_pcs=F('stock_pcs') - order.qty)
+                if not taken:
+                    break
+                order.transition(Order.PAYMENT_PENDING)
+        except (InvalidTransition, TransitionConflict):
+            # Changed meanwhile, the rollback gave the stock back.
+            continue
+
+        promoted += 1
+        # TODO: to notify the customer in-stock, need use websocket
+
+    return promoted
+
+
+def restore_stock(quantities):
+    '''
+    Give stock back with one UPDATE per product, then run one restock
+    backfill per product.
+
+    :param quantities: {product pk: qty to add back}
+    '''
+    for product_id, qty in quantities.items():
+        if qty:
+            Product.objects.filter(pk=product_id).update(
+                stock_pcs=F('stock_pcs') + qty)
+
+    for product_id in quantities:
+        backfill_restocked_orders(product_id)
+
+
+_BULK_CANCEL_SQL = '''
+WITH cancelled AS (
+    UPDATE shopper_order o
+    SET status = %(cancel)s, version = o.version + 1, updated_at = %(now)s
+    FROM (
+        SELECT id, status FROM shopper_order
+        WHERE order_id = ANY(%(order_ids)s)
+          AND status = ANY(%(cancellable)s)
+          {shop_filter}
+        FOR UPDATE
+    ) prev
+    WHERE o.id = prev.id
+    RETURNING o.product_id, o.qty, prev.status AS prev_status
+)
+SELECT product_id,
+       COALESCE(SUM(qty) FILTER (WHERE prev_status = ANY(%(holding)s)), 0),
+       COUNT(*)
+FROM cancelled
+GROUP BY product_id
+'''
+
+
+def bulk_cancel_orders(order_ids, shop_id=None):
+    '''
+    Cancel many orders at once: the statuses are flipped in one statement,
+    the stock they held is given back with one UPDATE per product and every
+    affected product gets a single restock backfill.
+
+    :param order_ids: Order.order_id list
+    :param shop_id: only cancel orders of this shop, if given
+    :return: number of cancelled orders
+    '''
+    params = {
+        'cancel': Order.CANCEL,
+        'order_ids': list(order_ids),
+        'cancellable': list(Order.CANCELLABLE_STATUSES),
+        'holding': list(Order.STOCK_HOLDING_STATUSES),
+        'shop_id': shop_id,
+        'now': timezone.now(),
+    }
+    shop_filter = 'AND shop_id = %(shop_id)s' if shop_id is not None else ''
+
+    with dtransaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(_BULK_CANCEL_SQL.format(shop_filter=shop_filter),
+                           params)
+            rows = cursor.fetchall()
+
+        restore_stock({product_id: qty for product_id, qty, _ in rows})
+
+    return sum(count for _, _, count in rows)
+
+
+# The range scan runs on the (status, reserved_at) index, the per order TTL
+# is checked on the few rows the index returns.
+_EXPIRE_RESERVATIONS_SQL = '''
+WITH expired AS (
+    UPDATE shopper_order o
+    SET status = %(expired)s, version = o.version + 1, updated_at = %(now)s
+    FROM (
+        SELECT o.id
+        FROM shopper_order o
+        JOIN shopper_product p ON p.id = o.product_id
+        LEFT JOIN shopper_shop s ON s.shop_id = o.shop_id
+        WHERE o.status = %(pending)s
+          AND o.reserved_at < %(cutoff)s
+          AND o.reserved_at < %(now)s - interval '1 second' *
+              COALESCE(p.reservation_ttl, s.reservation_ttl, %(default_ttl)s)
+        ORDER BY o.reserved_at
+        LIMIT %(batch_size)s
+        FOR UPDATE OF o SKIP LOCKED
+    ) due
+    WHERE o.id = due.id
+    RETURNING o.product_id, o.qty
+)
+SELECT product_id, SUM(qty), COUNT(*)
+FROM expired
+GROUP BY product_id
+'''
+
+
+def expire_reservations(batch_size=500):
+    '''
+    Expire PAYMENT_PENDING orders reserved (reserved_at) longer than their
+    TTL, in batches, and give their stock back with one UPDATE and one restock
+    backfill per product and batch. Rows locked by another sweeper or writer
+    are skipped, they are picked up on the next run.
+
+    :return: number of expired orders
+    '''
+    default_ttl = settings.ORDER_RESERVATION_TTL
+    ttls = [default_ttl]
+    ttls += [ttl for ttl in (
+        Product.objects.aggregate(ttl=models.Min('reservation_ttl'))['ttl'],
+        Shop.objects.aggregate(ttl=models.Min('reservation_ttl'))['ttl'],
+    ) if ttl is not None]
+
+    now = timezone.now()
+    params = {
+        'expired': Order.EXPIRED,
+        'pending': Order.PAYMENT_PENDING,
+        'now': now,
+        'cutoff': now - datetime.timedelta(seconds=min(ttls)),
+        'default_ttl': default_ttl,
+        'batch_size': batch_size,
+    }
+
+    total = 0
+    while True:
+        with dtransaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(_EXPIRE_RESERVATIONS_SQL, params)
+                rows = cursor.fetchall()
+
+            restore_stock({product_id: qty for product_id, qty, _ in rows})
+
+        expired = sum(count for _, _, count in rows)
+        total += expired
+        if expired < batch_size:
+            return total
+
+
+# Postgres 9.6 has no generated columns, a BEFORE trigger does the same.
+# Status-only updates (transitions, bulk cancel, expiry) do not fire it.
+_ORDER_TOTAL_FUNCTION_SQL = '''
+CREATE OR REPLACE FUNCTION shopper_order_total_price() RETURNS trigger AS $$
+BEGIN
+    NEW.total_price := NEW.qty * NEW.price;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+'''
+
+_ORDER_TOTAL_TRIGGER_SQL = '''
+CREATE TRIGGER shopper_order_total_price
+    BEFORE INSERT OR UPDATE OF qty, price, total_price ON shopper_order
+    FOR EACH ROW EXECUTE PROCEDURE shopper_order_total_price()
+'''
+
+# Totals written before the trigger existed.
+_ORDER_TOTAL_BACKFILL_SQL = '''
+UPDATE shopper_order SET total_price = qty * price
+WHERE total_price IS DISTINCT FROM qty * price
+'''
+
+
+def install_order_total_trigger(using='default', **kwargs):
+    '''
+    post_migrate handler (see ShopperConfig). Migrations are generated at
+    deploy time, so the trigger is installed after migrate rather than by
+    a migration. post_migrate also fires for other apps, and after
+    `migrate shopper zero`: nothing is done without the shopper_order table.
+    The full table backfill only runs when the trigger gets created, not on
+    every migrate (dev-entrypoint.sh migrates at each start).
+    '''
+    conn = connections[using]
+    if conn.vendor != 'postgresql':
+        return
+
+    with dtransaction.atomic(using=using), conn.cursor() as cursor:
+        if Order._meta.db_table not in \
+                conn.introspection.table_names(cursor):
+            return
+
+        cursor.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgname = %s "
+            "AND tgrelid = 'shopper_order'::regclass",
+            ['shopper_order_total_price'])
+        installed = cursor.fetchone() is not None
+
+        # Cheap, keeps the function body up to date.
+        cursor.execute(_ORDER_TOTAL_FUNCTION_SQL)
+        if not installed:
+            cursor.execute(_ORDER_TOTAL_TRIGGER_SQL)
+            cursor.execute(_ORDER_TOTAL_BACKFILL_SQL)
+
+
+@receiver(post_save, sender=Product)
+def sync_order_status(sender, instance, created=False, *args, **kargs):
+
+    # Always sync order status with the product
+    if not created and instance.stock_pcs > 0:
+        backfill_restocked_orders(instance.pk)
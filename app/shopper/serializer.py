@@ -1,7 +1,8 @@
 from rest_framework import serializers
 from django.db import transaction
 
-from shopper.models import Product, Order
+from shopper.models import Product, Order, restore_stock, \
+    InvalidTransition, TransitionConflict
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -22,6 +23,9 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = '__all__'
         ref_name = 'order_serializers'
 
+    def get_status(self, obj):
+        return obj.get_status_display()
+
     def to_internal_value(self, data):
         ret = super().to_internal_value(data)
         request = self.context['request']
@@ -46,6 +50,12 @@ class OrderSerializer(serializers.ModelSerializer):
         # 刪除訂單,庫存從0變回有值則提示商品到貨: this feature will be add to the
         # post_save() signal - sync_order_status() in models.py.
         if request.method == 'PATCH':
+            # Reject it here, before any stock gets touched.
+            if not self.instance.can_transition(Order.CANCEL):
+                raise serializers.ValidationError(
+                    f'Order in status {self.instance.get_status_display()} '
+                    f'can not be cancelled'
+                )
             data['status'] = Order.CANCEL
             return data
 
@@ -59,6 +69,8 @@ class OrderSerializer(serializers.ModelSerializer):
             # TODO: validate each attribute
             pass
 
+        return data
+
     @transaction.atomic
     def create(self, validated_data):
         product = validated_data['product']
@@ -79,13 +91,13 @@ class OrderSerializer(serializers.ModelSerializer):
 
     @transaction.atomic
     def update(self, instance, validated_data):
-        for key, val in validated_data.items():
-            setattr(instance, key, validated_data[key])
-        instance.save()
-
-        # increase Product.stock_pcs. Need lock object
-        product = Product.objects.select_for_update().get(pk=instance.id)
-        product.stock_pcs += instance.qty
-        product.save()
+        try:
+            prev_status = instance.transition(validated_data['status'])
+        except (InvalidTransition, TransitionConflict) as e:
+            raise serializers.ValidationError(str(e))
+
+        # Give the stock back, this also promotes orders waiting for it.
+        if prev_status in Order.STOCK_HOLDING_STATUSES:
+            restore_stock({instance.product_id: instance.qty})
 
         return instance
@@ -1,11 +1,19 @@
 import logging
+import datetime
 
 from mysite.celery import app
 from mysite.libs.classes import ExtendedCrontab
 from mysite.telegram_bot import send_telegram_notify
-from django.db.models import Sum, Count
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 
-from shopper.models import Product, Order, Shop
+from shopper.models import bulk_cancel_orders, backfill_restocked_orders, \
+    expire_reservations, IdempotencyKey
+
+# Written by refresh_top_products, read by the top 3 products view.
+TOP_PRODUCTS_CACHE_KEY = 'shopper:top_products'
+TOP_PRODUCTS_COUNT = 3
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -36,25 +44,41 @@ def setup_periodic_tasks(sender, **kwargs):
                              queue='periodic_queue',
                              name='creates daily report for today')
 
+    # every 15 seconds. A sweep nobody picked up before the next one is due
+    # is dropped.
+    sender.add_periodic_task(ExtendedCrontab(second='*/15'),
+                             expire_reservations_task.s(),
+                             expires=15,
+                             name='expires unpaid order reservations')
+
+    # every hour.
+    sender.add_periodic_task(ExtendedCrontab(minute=0),
+                             purge_idempotency_keys.s(),
+                             name='purges expired idempotency keys')
+
+    # every minute.
+    sender.add_periodic_task(ExtendedCrontab(minute='*'),
+                             refresh_top_products.s(),
+                             expires=60,
+                             name='refreshes the top products')
+
 
 @app.task(name='create_daily_report', base=CreateDailyReportTask,
           time_limit=600, soft_time_limit=570)
 def create_daily_report():
 
+    # NumPy is only loaded by the worker running the analytics tasks.
+    from shopper.analytics import get_snapshot
+
     telgram_msgs = []
 
 
-    query = Order.objects.exclude(status__in=[Order.FAIL, Order.CANCEL])
-    infos = query. \
-        values('product__shop_id'). \
-        annotate(total_order_price=Sum('total_price'),
-                 total_qty=Sum('qty'),
-                 total_order_count=Count('id'))
+    infos = get_snapshot(max_age=0).shop_totals()
 
     # 根據訂單記錄算出各個館別的1.總銷售金額 2.總銷售數量 3.總訂單數量
-    for info in infos:
+    for shop_id, info in infos.items():
         msg = \
-            f"館別: {info['product__shop_id']} \n" \
+            f"館別: {shop_id} \n" \
             f"總訂單數量: {info['total_order_count']} \n" \
             f"總銷售數量: {info['total_qty']} \n" \
             f"總銷售金額: {info['total_order_price']} \n" \
@@ -63,3 +87,50 @@ def create_daily_report():
 
     if telgram_msgs != []:
         send_telegram_notify(telgram_msgs)
+
+
+@app.task(name='bulk_cancel_orders', time_limit=600, soft_time_limit=570)
+def bulk_cancel_orders_task(order_ids, shop_id=None):
+    cancelled = bulk_cancel_orders(order_ids, shop_id=shop_id)
+    logger.info(f'Bulk cancel done. shop_id={shop_id}, '
+                f'requested={len(order_ids)}, cancelled={cancelled}')
+    return cancelled
+
+
+@app.task(name='backfill_restocked_products', time_limit=600,
+          soft_time_limit=570)
+def backfill_restocked_products(product_ids):
+    promoted = 0
+    for product_id in product_ids:
+        promoted += backfill_restocked_orders(product_id)
+    logger.info(f'Restock backfill done. products={len(product_ids)}, '
+                f'promoted orders={promoted}')
+    return promoted
+
+
+@app.task(name='expire_reservations', time_limit=60, soft_time_limit=50)
+def expire_reservations_task():
+    expired = expire_reservations(batch_size=settings.RESERVATION_SWEEP_BATCH)
+    if expired:
+        logger.info(f'Expired {expired} unpaid orders')
+    return expired
+
+
+@app.task(name='purge_idempotency_keys', time_limit=600, soft_time_limit=570)
+def purge_idempotency_keys():
+    expired_before = timezone.now() - datetime.timedelta(
+        seconds=settings.IDEMPOTENCY_TTL)
+    deleted, _ = IdempotencyKey.objects.filter(
+        created_at__lt=expired_before).delete()
+    return deleted
+
+
+@app.task(name='refresh_top_products', time_limit=60, soft_time_limit=50)
+def refresh_top_products():
+    from shopper.analytics import get_snapshot
+
+    top = get_snapshot(max_age=0).top_products(TOP_PRODUCTS_COUNT, by='qty')
+    hot_products = [product_id for product_id, _ in top]
+    # Outlives a couple of missed runs, then the view falls back to SQL.
+    cache.set(TOP_PRODUCTS_CACHE_KEY, hot_products, 5 * 60)
+    return hot_products
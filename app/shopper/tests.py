@@ -1,3 +1,839 @@
-from django.test import TestCase
+import io
+import re
+import time
+import datetime
+import threading
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from django.utils import timezone
 
 # Create your tests here.
+from shopper.models import Product, Order, Shop, IdempotencyKey, \
+    InvalidTransition, TransitionConflict, bulk_cancel_orders, \
+    expire_reservations, install_order_total_trigger
+from shopper.admin import ProductAdmin
+from shopper.views import filter_orders, BULK_CANCEL_SYNC_LIMIT
+from shopper.analytics import OrderSnapshot
+from shopper.catalog import import_catalog, CatalogError
+from shopper.utils import TokenBucket, ConcurrencyLimit
+from mysite.libs import constants
+
+
+class OrderListFilterIndexTest(TestCase):
+    '''
+    Every filter combination of the order list must be served by an index
+    on the filtered columns. A plain `Index` in the plan proves nothing:
+    with the -created_at ordering Postgres can always walk the created_at
+    index backwards and filter the rows. So the plan must have an Index Cond
+    on all the filtered columns.
+
+    The table gets enough varied rows and statistics for the planner to
+    pick like it would on real data, seq scans are disabled on top.
+    '''
+
+    SHOPS = 20
+    ORDERS = 3000
+
+    @classmethod
+    def setUpTestData(cls):
+        products = [
+            Product.objects.create(product_id=f'p{i}', stock_pcs=10, price=10,
+                                   shop_id=f's{i % cls.SHOPS}')
+            for i in range(50)
+        ]
+        statuses = [status for status, _ in Order.ORDER_STATUS_OPTIONS]
+        Order.objects.bulk_create([
+            # Generated order_ids can collide when thousands are built in
+            # the same second.
+            Order(order_id=f'plan{i}', product=products[i % len(products)],
+                  qty=1, price=10, shop_id=f's{i % cls.SHOPS}',
+                  status=statuses[i % len(statuses)])
+            for i in range(cls.ORDERS)
+        ])
+        with connection.cursor() as cursor:
+            # One order per minute back from now.
+            cursor.execute("UPDATE shopper_order SET created_at = "
+                           "now() - id * interval '1 minute'")
+            cursor.execute('ANALYZE shopper_order')
+
+    def explain(self, params):
+        queryset = filter_orders(
+            Order.objects.select_related('product').order_by('-created_at'),
+            params)
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            return queryset.explain()
+
+    def assertIndexCond(self, params, columns):
+        plan = self.explain(params)
+        self.assertNotIn('Seq Scan on shopper_order', plan, msg=plan)
+        conds = [line for line in plan.splitlines() if 'Index Cond:' in line]
+        self.assertTrue(
+            any(all(re.search(rf'\b{column}\b', cond) for column in columns)
+                for cond in conds),
+            msg=f'no Index Cond on {", ".join(columns)}\n{plan}')
+        return plan
+
+    def since(self, hours):
+        return (timezone.now() - datetime.timedelta(hours=hours)).isoformat()
+
+    def test_no_filter(self):
+        plan = self.explain({})
+        self.assertIn('Index Scan Backward using shopper_order_created_at',
+                      plan)
+
+    def test_shop_id(self):
+        self.assertIndexCond({'shop_id': 's1'}, ['shop_id'])
+
+    def test_status(self):
+        self.assertIndexCond({'status': '3'}, ['status'])
+
+    def test_status_set(self):
+        self.assertIndexCond({'status': '1,3'}, ['status'])
+
+    def test_product_id(self):
+        self.assertIndexCond({'product_id': 'p1'}, ['product_id'])
+
+    def test_created_range(self):
+        self.assertIndexCond({'created_after': self.since(24),
+                              'created_before': self.since(12)},
+                             ['created_at'])
+
+    def test_shop_id_and_status(self):
+        self.assertIndexCond({'shop_id': 's1', 'status': '1,3'},
+                             ['shop_id', 'status'])
+
+    def test_shop_id_and_created_range(self):
+        self.assertIndexCond({'shop_id': 's1', 'created_after': self.since(24)},
+                             ['shop_id', 'created_at'])
+
+    def test_status_and_created_range(self):
+        self.assertIndexCond({'status': '3', 'created_after': self.since(24)},
+                             ['status', 'created_at'])
+
+    def test_product_id_and_created_range(self):
+        self.assertIndexCond(
+            {'product_id': 'p1', 'created_after': self.since(24)},
+            ['product_id', 'created_at'])
+
+    def test_active_orders_of_shop(self):
+        plan = self.assertIndexCond({
+            'shop_id': 's1',
+            'status': ','.join(str(status)
+                               for status in Order.ACTIVE_STATUSES),
+            'created_after': self.since(24),
+        }, ['shop_id', 'created_at'])
+        # The statuses are the partial index predicate.
+        self.assertIn('order_shop_active_idx', plan)
+
+    def test_active_statuses(self):
+        # ACTIVE_ORDER_STATUSES spells the codes out for the partial index.
+        self.assertEqual(
+            set(Order.ACTIVE_STATUSES),
+            {Order.SUCCESS, Order.PAYMENT_PENDING, Order.NOT_IN_STOCK})
+
+    def test_invalid_dates(self):
+        for value in ('yesterday', '2020-13-01T00:00:00',
+                      '2020-02-30T00:00:00'):
+            with self.subTest(value=value), \
+                    self.assertRaises(ValidationError):
+                filter_orders(Order.objects.all(), {'created_after': value})
+
+
+class ProductSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create([
+            Product(product_id=f'p{i}', stock_pcs=1, price=1)
+            for i in range(2000)
+        ] + [Product(product_id='P12x', stock_pcs=1, price=1)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE shopper_product')
+
+    def search(self, term):
+        queryset, distinct = ProductAdmin(Product, admin.site) \
+            .get_search_results(None, Product.objects.all(), term)
+        self.assertFalse(distinct)
+        return queryset
+
+    def test_prefix_match(self):
+        found = self.search(' p12 ').values_list('product_id', flat=True)
+        # p12, p120-p129 and p1200-p1299, not P12x.
+        self.assertEqual(len(found), 111)
+        self.assertTrue(all(product_id.startswith('p12')
+                            for product_id in found))
+        self.assertEqual(self.search('').count(), 2001)
+
+    def test_uses_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = self.search('p12').explain()
+        self.assertNotIn('Seq Scan', plan, msg=plan)
+        self.assertRegex(plan, r'Index Cond: .*product_id', msg=plan)
+
+
+class OrderTotalPriceTest(TestCase):
+    '''
+    total_price is maintained by the database, whichever way the order is
+    written.
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(product_id='p1', stock_pcs=10,
+                                             price=2.5, shop_id='um')
+
+    def new_order(self, qty, price, **kwargs):
+        kwargs.setdefault('shop_id', 'um')
+        return Order(product=self.product, qty=qty, price=price, **kwargs)
+
+    def assertTotalsCorrect(self):
+        stale = Order.objects.exclude(total_price=F('qty') * F('price'))
+        self.assertFalse(stale.exists(), msg=list(stale.values(
+            'id', 'qty', 'price', 'total_price')))
+
+    def test_save(self):
+        order = self.new_order(3, 2.5)
+        order.save()
+        self.assertEqual(order.total_price, 7.5)
+        order.refresh_from_db()
+        self.assertEqual(order.total_price, 7.5)
+
+    def test_bulk_create(self):
+        Order.objects.bulk_create(
+            [self.new_order(qty, 2.5) for qty in range(1, 6)])
+        self.assertTotalsCorrect()
+        self.assertEqual(
+            Order.objects.aggregate(total=Sum('total_price'))['total'], 37.5)
+
+    def test_bulk_update(self):
+        Order.objects.bulk_create(
+            [self.new_order(qty, 2.5) for qty in range(1, 4)])
+        orders = list(Order.objects.all())
+        for order in orders:
+            order.qty *= 2
+            order.price = 4
+        Order.objects.bulk_update(orders, ['qty', 'price'])
+        self.assertTotalsCorrect()
+        self.assertEqual(
+            Order.objects.aggregate(total=Sum('total_price'))['total'], 48)
+
+    def test_queryset_update(self):
+        Order.objects.bulk_create(
+            [self.new_order(1, 2.5), self.new_order(2, 2.5)])
+        Order.objects.update(qty=F('qty') + 1)
+        self.assertTotalsCorrect()
+        Order.objects.filter(qty=3).update(price=10)
+        self.assertTotalsCorrect()
+        self.assertEqual(
+            Order.objects.aggregate(total=Sum('total_price'))['total'], 35)
+
+    def test_total_price_can_not_be_overwritten(self):
+        order = self.new_order(2, 2.5)
+        order.save()
+        Order.objects.filter(pk=order.pk).update(total_price=0)
+        order.refresh_from_db()
+        self.assertEqual(order.total_price, 5)
+
+    def test_raw_insert(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO shopper_order (product_id, qty, price, status, '
+                'version, created_at, updated_at, reserved_at) '
+                'VALUES (%s, 4, 1.5, %s, 0, now(), now(), now())',
+                [self.product.pk, Order.PAYMENT_PENDING])
+        self.assertEqual(Order.objects.get().total_price, 6)
+
+    def test_install_fixes_stale_totals_once(self):
+        order = self.new_order(2, 2.5)
+        order.save()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DROP TRIGGER shopper_order_total_price ON shopper_order')
+        Order.objects.filter(pk=order.pk).update(total_price=0)
+
+        install_order_total_trigger()
+        self.assertTotalsCorrect()
+
+        # Already installed: no full table UPDATE on the next migrate.
+        with CaptureQueriesContext(connection) as queries:
+            install_order_total_trigger()
+        self.assertFalse([query for query in queries
+                          if query['sql'].lstrip().startswith('UPDATE')])
+
+    def test_install_without_order_table(self):
+        # e.g. `migrate shopper zero`, or migrating an app before shopper.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'ALTER TABLE shopper_order RENAME TO shopper_order_moved')
+        try:
+            install_order_total_trigger()
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'ALTER TABLE shopper_order_moved RENAME TO shopper_order')
+
+    def test_status_changes_keep_total(self):
+        orders = [self.new_order(qty, 2.5, order_id=f'o{qty}')
+                  for qty in (1, 2, 3)]
+        Order.objects.bulk_create(orders)
+        bulk_cancel_orders(['o1', 'o2'])
+        Order.objects.get(order_id='o3').transition(Order.SUCCESS)
+        self.assertTotalsCorrect()
+        self.assertEqual(
+            Order.objects.filter(status=Order.CANCEL).aggregate(
+                total=Sum('total_price'))['total'], 7.5)
+
+
+class OrderTransitionTest(TestCase):
+
+    def setUp(self):
+        self.product = Product.objects.create(product_id='p1', stock_pcs=5,
+                                              price=2, shop_id='um')
+        self.order = Order.objects.create(product=self.product, qty=2,
+                                          price=2, shop_id='um')
+
+    def bump(self, **changes):
+        # Another writer updating the order behind self.order's back.
+        Order.objects.filter(pk=self.order.pk).update(
+            version=F('version') + 1, **changes)
+
+    def assertStored(self, status, version):
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual((order.status, order.version), (status, version))
+
+    def test_transition(self):
+        self.assertEqual(self.order.transition(Order.SUCCESS),
+                         Order.PAYMENT_PENDING)
+        self.assertEqual((self.order.status, self.order.version),
+                         (Order.SUCCESS, 1))
+        self.assertStored(Order.SUCCESS, 1)
+
+    def test_invalid_transition(self):
+        self.order.transition(Order.FAIL)
+        with self.assertNumQueries(0), \
+                self.assertRaises(InvalidTransition):
+            self.order.transition(Order.CANCEL)
+        self.assertStored(Order.FAIL, 1)
+
+    def test_conflict_is_retried(self):
+        self.bump()
+        self.order.transition(Order.SUCCESS)
+        self.assertStored(Order.SUCCESS, 2)
+
+    def test_retry_checks_the_new_status(self):
+        # Cancelled meanwhile, paying it is no longer possible.
+        self.bump(status=Order.CANCEL)
+        with self.assertRaises(InvalidTransition):
+            self.order.transition(Order.SUCCESS)
+        self.assertStored(Order.CANCEL, 1)
+
+    def test_gives_up_after_max_retries(self):
+        refresh_from_db = Order.refresh_from_db
+        retries = []
+
+        def refresh_and_lose(order, **kwargs):
+            refresh_from_db(order, **kwargs)
+            if order is self.order:
+                retries.append(order.version)
+                self.bump()
+
+        self.bump()
+        with mock.patch.object(Order, 'refresh_from_db', autospec=True,
+                               side_effect=refresh_and_lose), \
+                self.assertRaises(TransitionConflict):
+            self.order.transition(Order.SUCCESS, max_retries=3)
+        self.assertEqual(retries, [1, 2, 3])
+        self.assertStored(Order.PAYMENT_PENDING, 4)
+
+    def patch_cancel(self):
+        return APIClient().patch(f'/shopper/order/{self.order.pk}/',
+                                 {'status': 'cancel'}, format='json')
+
+    def test_cancel(self):
+        self.assertEqual(self.patch_cancel().status_code, 200)
+        self.assertStored(Order.CANCEL, 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_pcs, 7)
+
+    def test_cancel_twice(self):
+        self.patch_cancel()
+        response = self.patch_cancel()
+        self.assertEqual(response.status_code, 400)
+        self.assertStored(Order.CANCEL, 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_pcs, 7)
+
+
+class BulkCancelTest(TestCase):
+
+    def setUp(self):
+        self.product = Product.objects.create(product_id='p1', stock_pcs=10,
+                                              price=1, shop_id='um')
+        self.other_product = Product.objects.create(
+            product_id='p2', stock_pcs=10, price=1, shop_id='other')
+        self.orders = {
+            status: Order.objects.create(product=self.product, qty=qty,
+                                         price=1, shop_id='um', status=status)
+            for status, qty in ((Order.SUCCESS, 1), (Order.PAYMENT_PENDING, 2),
+                                (Order.NOT_IN_STOCK, 4), (Order.FAIL, 8),
+                                (Order.CANCEL, 16), (Order.EXPIRED, 32))
+        }
+        self.other = Order.objects.create(product=self.other_product, qty=1,
+                                          price=1, shop_id='other')
+        self.order_ids = [order.order_id
+                          for order in Order.objects.all()]
+
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True))
+
+    def statuses(self):
+        return dict(Order.objects.values_list('order_id', 'status'))
+
+    def stock(self, product):
+        product.refresh_from_db()
+        return product.stock_pcs
+
+    def test_cancel(self):
+        self.assertEqual(bulk_cancel_orders(self.order_ids, shop_id='um'), 3)
+
+        after = self.statuses()
+        for status, order in self.orders.items():
+            expected = Order.CANCEL \
+                if status in Order.CANCELLABLE_STATUSES else status
+            self.assertEqual(after[order.order_id], expected)
+        # Other shop's order left alone, not cancellable ones not rewritten.
+        self.assertEqual(after[self.other.order_id], Order.PAYMENT_PENDING)
+        self.assertEqual(Order.objects.filter(version=0).count(), 4)
+
+        # Only SUCCESS and PAYMENT_PENDING held stock (1 + 2).
+        self.assertEqual(self.stock(self.product), 13)
+        self.assertEqual(self.stock(self.other_product), 10)
+
+    def test_cancel_all_shops(self):
+        self.assertEqual(bulk_cancel_orders(self.order_ids), 4)
+        self.assertEqual(self.statuses()[self.other.order_id], Order.CANCEL)
+        self.assertEqual(self.stock(self.other_product), 11)
+
+    def test_cancel_again(self):
+        bulk_cancel_orders(self.order_ids)
+        self.assertEqual(bulk_cancel_orders(self.order_ids), 0)
+        self.assertEqual(self.stock(self.product), 13)
+
+    def post(self, data):
+        return self.client.post('/shopper/order/bulk_cancel/', data,
+                                format='json')
+
+    def test_view(self):
+        response = self.post({'order_ids': self.order_ids, 'shop_id': 'um'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {constants.ALL_OK: {'cancelled': 3}})
+        self.assertEqual(self.post({'order_ids': []}).status_code, 400)
+
+    @mock.patch('shopper.views.bulk_cancel_orders_task')
+    def test_big_batch_goes_to_celery(self, task):
+        task.delay.return_value.id = 'task-1'
+        order_ids = self.order_ids + [
+            f'missing{i}' for i in range(BULK_CANCEL_SYNC_LIMIT)]
+        response = self.post({'order_ids': order_ids, 'shop_id': 'um'})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data,
+                         {constants.ALL_OK: {'task_id': 'task-1'}})
+        task.delay.assert_called_once_with(order_ids, shop_id='um')
+        self.assertEqual(Order.objects.filter(status=Order.CANCEL).count(),
+                         1)
+
+
+class OrderSnapshotTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(product_id='p1', stock_pcs=10,
+                                             price=2, shop_id='um')
+
+    def create_order(self, order_id, qty, age=None):
+        order = Order.objects.create(product=self.product, qty=qty, price=2,
+                                     shop_id='um', order_id=order_id,
+                                     status=Order.SUCCESS)
+        if age is not None:
+            Order.objects.filter(pk=order.pk).update(
+                created_at=timezone.now() - age)
+        return order
+
+    def test_old_orders_cancelled_after_load(self):
+        self.create_order('old', 3, age=datetime.timedelta(days=30))
+        self.create_order('new', 1)
+        snapshot = OrderSnapshot().refresh()
+        self.assertEqual(snapshot.shop_totals()['um']['total_qty'], 4)
+
+        bulk_cancel_orders(['old'])
+        snapshot.refresh()
+        self.assertEqual(snapshot.shop_totals()['um']['total_qty'], 1)
+
+    def test_rows_committed_late(self):
+        self.create_order('first', 1)
+        snapshot = OrderSnapshot().refresh()
+        # Committed after the refresh, with a created_at before its watermark.
+        self.create_order('late', 2, age=datetime.timedelta(seconds=30))
+        Order.objects.filter(order_id='late').update(
+            created_at=snapshot.watermark - datetime.timedelta(seconds=1))
+        snapshot.refresh()
+        snapshot.refresh()
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(snapshot.shop_totals()['um']['total_qty'], 3)
+
+
+class CatalogImportErrorTest(TestCase):
+
+    def assertCatalogError(self, fmt, data, message):
+        with self.assertRaisesMessage(CatalogError, message):
+            import_catalog(io.StringIO(data), fmt)
+        self.assertFalse(Product.objects.exists())
+
+    def test_csv(self):
+        header = 'product_id,stock_pcs,price\n'
+        cases = [
+            ('a,1,2\n\nb,x,3\n', 'line 4: invalid input syntax'),
+            ('a,1,2\nb,1\n', 'line 3: expected 3 columns, got 2'),
+            ('"a\nb",1,2\n,4,5\n', 'line 4: null value'),
+        ]
+        for data, message in cases:
+            with self.subTest(data=data):
+                self.assertCatalogError('csv', header + data, message)
+
+    def test_csv_header(self):
+        cases = [
+            ('product_id,price,price\na,1,2\n', 'duplicate columns: price'),
+            ('product_id,stok_pcs\na,1\n', 'unknown columns: stok_pcs'),
+            ('price\n1\n', 'product_id column is required'),
+        ]
+        for data, message in cases:
+            with self.subTest(data=data):
+                self.assertCatalogError('csv', data, message)
+
+    def test_ndjson(self):
+        first = '{"product_id": "a", "stock_pcs": 1}\n'
+        cases = [
+            (first + '\n[1, 2]\n', 'line 3: expected a JSON object'),
+            (first + '{bad\n', 'line 2: invalid JSON'),
+            (first + '{"product_id": "b", "stock_pcs": "x"}\n',
+             'line 2: invalid input syntax'),
+            (first + '{"product_id": "b", "price": 9, "stok_pcs": 5}\n',
+             'line 2: columns not in the first record: price, stok_pcs'),
+        ]
+        for data, message in cases:
+            with self.subTest(data=data):
+                self.assertCatalogError('ndjson', data, message)
+
+
+
+class CatalogImportTest(TestCase):
+
+    def setUp(self):
+        self.empty = Product.objects.create(product_id='p1', stock_pcs=0,
+                                            price=5, shop_id='um')
+        self.stocked = Product.objects.create(product_id='p2', stock_pcs=3,
+                                              price=7, shop_id='um')
+
+    def products(self):
+        return {product.product_id: (product.stock_pcs, product.price,
+                                     product.shop_id, product.vip)
+                for product in Product.objects.all()}
+
+    def test_csv_upsert(self):
+        result = import_catalog(io.StringIO(
+            'product_id,stock_pcs,price\n'
+            'p1,4,\n'
+            'p2,0,8\n'
+            'p3,2,1.5\n'
+            'p1,5,\n'), 'csv')
+
+        # p1: last line wins, empty price kept. p3: new, model defaults.
+        self.assertEqual(self.products(), {
+            'p1': (5, 5, 'um', False),
+            'p2': (0, 8, 'um', False),
+            'p3': (2, 1.5, None, False),
+        })
+        self.assertEqual(result, {'rows': 4, 'restocked': [self.empty.pk]})
+
+    def test_ndjson_upsert(self):
+        result = import_catalog(io.StringIO(
+            '{"product_id": "p1", "stock_pcs": 1, "vip": true}\n'
+            '{"product_id": "p4"}\n'), 'ndjson')
+
+        self.assertEqual(self.products(), {
+            'p1': (1, 5, 'um', True),
+            'p2': (3, 7, 'um', False),
+            'p4': (0, 0, None, False),
+        })
+        self.assertEqual(result, {'rows': 2, 'restocked': [self.empty.pk]})
+
+    def test_product_ids_only(self):
+        result = import_catalog(io.StringIO('product_id\np2\np5\n'), 'csv')
+        self.assertEqual(self.products()['p2'], (3, 7, 'um', False))
+        self.assertEqual(self.products()['p5'], (0, 0, None, False))
+        self.assertEqual(result, {'rows': 2, 'restocked': []})
+
+
+@override_settings(ORDER_RESERVATION_TTL=900)
+class ReservationExpiryTest(TestCase):
+
+    def setUp(self):
+        self.product = Product.objects.create(product_id='p1', stock_pcs=0,
+                                              price=1, shop_id='um')
+
+    def create_order(self, qty, status=Order.PAYMENT_PENDING, age=0,
+                     product=None):
+        reserved_at = timezone.now() - datetime.timedelta(seconds=age)
+        return Order.objects.create(product=product or self.product, qty=qty,
+                                    price=1, shop_id='um', status=status,
+                                    reserved_at=reserved_at)
+
+    def assertStatus(self, order, status):
+        order.refresh_from_db()
+        self.assertEqual(order.status, status)
+
+    def test_expires_overdue_orders_and_restores_stock_per_product(self):
+        other = Product.objects.create(product_id='p2', stock_pcs=0,
+                                       price=1, shop_id='um')
+        overdue = [self.create_order(2, age=1000),
+                   self.create_order(3, age=2000),
+                   self.create_order(4, age=1000, product=other)]
+        fresh = self.create_order(1, age=10)
+
+        self.assertEqual(expire_reservations(batch_size=2), 3)
+        for order in overdue:
+            self.assertStatus(order, Order.EXPIRED)
+        self.assertStatus(fresh, Order.PAYMENT_PENDING)
+        self.product.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.product.stock_pcs, other.stock_pcs), (5, 4))
+
+    def test_restored_stock_goes_to_waiting_orders(self):
+        self.create_order(3, age=1000)
+        waiting = self.create_order(2, status=Order.NOT_IN_STOCK, age=5000)
+
+        self.assertEqual(expire_reservations(), 1)
+        self.assertStatus(waiting, Order.PAYMENT_PENDING)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_pcs, 1)
+
+    def test_promoted_order_gets_a_new_reservation(self):
+        waiting = self.create_order(2, status=Order.NOT_IN_STOCK, age=5000)
+        self.product.stock_pcs = 2
+        self.product.save()
+        self.assertStatus(waiting, Order.PAYMENT_PENDING)
+
+        self.assertEqual(expire_reservations(), 0)
+        self.assertStatus(waiting, Order.PAYMENT_PENDING)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_pcs, 0)
+
+    def test_product_and_shop_ttl(self):
+        Shop.objects.create(shop_id='um', reservation_ttl=60)
+        by_shop = self.create_order(1, age=100)
+        other = Product.objects.create(product_id='p2', stock_pcs=0, price=1,
+                                       shop_id='um', reservation_ttl=3600)
+        by_product = self.create_order(1, age=100, product=other)
+
+        self.assertEqual(expire_reservations(), 1)
+        self.assertStatus(by_shop, Order.EXPIRED)
+        self.assertStatus(by_product, Order.PAYMENT_PENDING)
+
+
+@override_settings(ORDER_RESERVATION_TTL=900)
+class ReservationExpiryLockTest(TransactionTestCase):
+
+    def test_skips_locked_orders(self):
+        product = Product.objects.create(product_id='p1', stock_pcs=0,
+                                         price=1, shop_id='um')
+        reserved_at = timezone.now() - datetime.timedelta(seconds=1000)
+        locked, free = [
+            Order.objects.create(product=product, qty=1, price=1,
+                                 shop_id='um', reserved_at=reserved_at)
+            for _ in range(2)
+        ]
+
+        other = connection.copy()
+        try:
+            other.set_autocommit(False)
+            with other.cursor() as cursor:
+                cursor.execute('SELECT id FROM shopper_order WHERE id = %s '
+                               'FOR UPDATE', [locked.pk])
+            self.assertEqual(expire_reservations(), 1)
+            free.refresh_from_db()
+            self.assertEqual(free.status, Order.EXPIRED)
+            other.rollback()
+        finally:
+            other.close()
+
+        self.assertEqual(expire_reservations(), 1)
+        locked.refresh_from_db()
+        self.assertEqual(locked.status, Order.EXPIRED)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdmissionControlTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.clock = Clock()
+        patcher = mock.patch('shopper.utils._clock', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket('test', rate=1, capacity=2)
+        self.assertEqual([bucket.take('k') for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(bucket.take('k'), 1)
+
+        self.clock.now += 0.5
+        self.assertAlmostEqual(bucket.take('k'), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(bucket.take('k'), 0)
+
+        # Idle for long, still only `capacity` tokens in a row.
+        self.clock.now += 100
+        self.assertEqual([bucket.take('k') > 0 for _ in range(3)],
+                         [False, False, True])
+
+    def test_concurrency_limit(self):
+        limits = [ConcurrencyLimit('test', 2) for _ in range(3)]
+        self.assertEqual([limit.acquire() for limit in limits],
+                         [True, True, False])
+        limits[0].release()
+        self.assertTrue(limits[2].acquire())
+
+    @override_settings(ORDER_ADMISSION={
+        'CUSTOMER_RATE': 0.1, 'CUSTOMER_BURST': 1, 'PRODUCT_RATE': 100,
+        'PRODUCT_BURST': 100, 'MAX_IN_FLIGHT': 8, 'RETRY_AFTER': 1})
+    def test_shed_requests_are_not_replayed(self):
+        Product.objects.create(product_id='p1', stock_pcs=10, price=1,
+                               shop_id='um')
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('u1'))
+
+        def create_order(key):
+            return client.post('/shopper/order/',
+                               {'product_id': 'p1', 'qty': 1},
+                               format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+        self.assertEqual(create_order('k1').status_code, 201)
+        shed = create_order('k2')
+        self.assertEqual(shed.status_code, 429)
+        self.assertEqual(shed['Retry-After'], '10')
+
+        self.clock.now += 10
+        self.assertEqual(create_order('k2').status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+
+
+@override_settings(IDEMPOTENCY_WAIT=0.3, ORDER_ADMISSION={
+    'CUSTOMER_RATE': 100, 'CUSTOMER_BURST': 100, 'PRODUCT_RATE': 100,
+    'PRODUCT_BURST': 100, 'MAX_IN_FLIGHT': 8, 'RETRY_AFTER': 1})
+class IdempotencyKeyTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(product_id='p1', stock_pcs=10,
+                                              price=1, shop_id='um')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('u1'))
+
+    def create_order(self, key, qty=1, client=None):
+        return (client or self.client).post(
+            '/shopper/order/', {'product_id': 'p1', 'qty': qty},
+            format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_is_replayed(self):
+        first = self.create_order('k1')
+        retry = self.create_order('k1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(Order.objects.count(), 1)
+
+        # Also from the DB once the cache lost it.
+        cache.clear()
+        self.assertEqual(self.create_order('k1').json(), first.json())
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_other_body_is_rejected(self):
+        self.create_order('k1')
+        self.assertEqual(self.create_order('k1', qty=2).status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_keys_are_per_user(self):
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user('u2'))
+        self.create_order('k1')
+        response = self.create_order('k1', client=other)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_anonymous_key_is_refused(self):
+        response = self.create_order('k1', client=APIClient())
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+    def in_flight(self, key):
+        # The state of `key` while its first request is still running.
+        first = self.create_order(key)
+        cache.clear()
+        row = IdempotencyKey.objects.get()
+        record = dict(row.as_record(), created_at=timezone.now())
+        IdempotencyKey.objects.update(status_code=None, response=None)
+        return first, record
+
+    def test_in_flight_duplicate_waits_for_the_first(self):
+        first, record = self.in_flight('k1')
+        key = IdempotencyKey.objects.get().key
+        finish = threading.Timer(
+            0.1, cache.set, [f'idempotency:{key}', record])
+        finish.start()
+        self.addCleanup(finish.cancel)
+
+        started = time.monotonic()
+        response = self.create_order('k1')
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(response.json(), first.json())
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_in_flight_duplicate_times_out(self):
+        self.in_flight('k1')
+        started = time.monotonic()
+        response = self.create_order('k1')
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_in_flight_other_body_is_rejected_at_once(self):
+        self.in_flight('k1')
+        started = time.monotonic()
+        self.assertEqual(self.create_order('k1', qty=2).status_code, 422)
+        self.assertLess(time.monotonic() - started, 0.3)
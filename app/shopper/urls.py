@@ -4,7 +4,13 @@ from shopper import views as shopper
 
 
 urlpatterns = [
-    path('product/', shopper.ProductViewSet.as_view(), name='product'),
-    path('order/', shopper.OrderViewSet.as_view(), name='order'),
+    path('product/', shopper.ProductViewSet.as_view({'get': 'list'}),
+         name='product'),
+    path('product/import/', shopper.import_products, name='import_products'),
+    path('order/', shopper.OrderViewSet.as_view(
+        {'get': 'list', 'post': 'create'}), name='order'),
+    path('order/<int:pk>/', shopper.OrderViewSet.as_view(
+        {'patch': 'partial_update'}), name='order_detail'),
+    path('order/bulk_cancel/', shopper.bulk_cancel, name='bulk_cancel'),
     path('top_3_products/', shopper.get_top_3_products, name='get_top_3_products'),
 ]
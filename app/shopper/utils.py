@@ -1,22 +1,41 @@
+import json
+import math
+import time
+import uuid
+import random
+import hashlib
+import datetime
 from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from shopper.models import Product
+from shopper.models import Product, IdempotencyKey
 from mysite.libs import constants
 
 
+def _get_request(args):
+    # Works for view methods (self, request) and function views (request).
+    return args[1] if isinstance(args[0], APIView) else args[0]
+
 
 def vip_required(function):
   @wraps(function)
-  def wrap(request, *args, **kwargs):
+  def wrap(*args, **kwargs):
+        request = _get_request(args)
         product_id = request.data.get('product_id')
         if product_id:
             product = Product.objects.filter(product_id=product_id).first()
             if product:
-                if product.vip:
-                    customer = request.user.customer_user
-                    if customer.is_vip:
-                        return function(request, *args, **kwargs)
+                if not product.vip:
+                    return function(*args, **kwargs)
+                customer = getattr(request.user, 'customer_user', None)
+                if customer and customer.is_vip:
+                    return function(*args, **kwargs)
 
         res = {constants.NOT_OK: 'vip check fail'}
         return Response(res, status=400)
@@ -26,16 +45,292 @@ def vip_required(function):
 
 def check_stock(function):
   @wraps(function)
-  def wrap(request, *args, **kwargs):
+  def wrap(*args, **kwargs):
+        request = _get_request(args)
         product_id = request.data.get('product_id')
         if product_id:
             product = Product.objects.filter(product_id=product_id).first()
             if product:
                 order_qty = int(request.data.get('qty'))
                 if order_qty <= product.stock_pcs:
-                    return function(request, *args, **kwargs)
+                    return function(*args, **kwargs)
 
         res = {constants.NOT_OK: 'not in stock'}
         return Response(res, status=400)
 
   return wrap
+
+
+def _idempotency_record(key):
+    '''
+    The stored result of `key`: the shared cache first, the DB as fallback.
+    '''
+    record = cache.get(f'idempotency:{key}')
+    if record is None:
+        row = IdempotencyKey.objects.filter(key=key).first()
+        if row is not None:
+            record = row.as_record()
+            if row.status_code is not None:
+                cache.set(f'idempotency:{key}', record,
+                          settings.IDEMPOTENCY_TTL)
+    return record
+
+
+def _wait_for_idempotency_record(key):
+    # A duplicate of a request still running: wait a bit for its response
+    # instead of executing it a second time. Only finished responses are
+    # cached, the DB is checked once more at the end.
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    while time.monotonic() < deadline:
+        record = cache.get(f'idempotency:{key}')
+        if record is not None:
+            return record
+        time.sleep(0.05)
+    return _idempotency_record(key)
+
+
+def idempotent(function):
+    '''
+    Support for the Idempotency-Key header. The first request with a key runs,
+    its response is stored (shared cache, DB as fallback) together with a
+    fingerprint of the request body. Retries with the same key get the stored
+    response replayed, concurrent duplicates wait for the first one to finish
+    (409 if it takes longer than IDEMPOTENCY_WAIT). A retry with the same key
+    but another body is rejected.
+
+    Keys are scoped per user, anonymous requests can not use the header.
+    '''
+    @wraps(function)
+    def wrap(*args, **kwargs):
+        request = _get_request(args)
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not idempotency_key:
+            return function(*args, **kwargs)
+
+        if not request.user.is_authenticated:
+            res = {constants.NOT_OK:
+                   'Idempotency-Key requires an authenticated user'}
+            return Response(res, status=400)
+
+        key = hashlib.sha256(
+            f'{request.user.pk}:{request.path}:{idempotency_key}'.encode()
+        ).hexdigest()
+        fingerprint = hashlib.sha256(json.dumps(
+            request.data, sort_keys=True, default=str).encode()).hexdigest()
+
+        record = _idempotency_record(key)
+        if record is not None and record['status_code'] is None and \
+                record['created_at'] < timezone.now() - datetime.timedelta(
+                    seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT):
+            # The request holding the key died, let this one take it over.
+            IdempotencyKey.objects.filter(
+                key=key, status_code__isnull=True).delete()
+            record = None
+
+        if record is None:
+            try:
+                with transaction.atomic():
+                    IdempotencyKey.objects.create(key=key,
+                                                  fingerprint=fingerprint)
+            except IntegrityError:
+                # Lost the race, the winner is still running.
+                record = _wait_for_idempotency_record(key)
+            else:
+                return _run_idempotent(function, key, fingerprint,
+                                       *args, **kwargs)
+        elif record['status_code'] is None and \
+                record['fingerprint'] == fingerprint:
+            record = _wait_for_idempotency_record(key)
+
+        if record is not None and record['fingerprint'] != fingerprint:
+            res = {constants.NOT_OK:
+                   'Idempotency-Key was already used for another request'}
+            return Response(res, status=422)
+
+        # Still running, or it failed and released the key: retry.
+        if record is None or record['status_code'] is None:
+            res = {constants.NOT_OK:
+                   'a request with this Idempotency-Key is in progress'}
+            return Response(res, status=409, headers={'Retry-After': '1'})
+
+        return Response(record['data'], status=record['status_code'],
+                        headers={'Idempotent-Replayed': 'true'})
+
+    return wrap
+
+
+def _run_idempotent(function, key, fingerprint, *args, **kwargs):
+    try:
+        response = function(*args, **kwargs)
+    except Exception:
+        IdempotencyKey.objects.filter(key=key).delete()
+        raise
+
+    # Server errors, shed (429) and conflicting (409) requests are not
+    # stored: the client is told to retry them with the same key.
+    if response.status_code >= 500 or response.status_code in (409, 429):
+        IdempotencyKey.objects.filter(key=key).delete()
+        return response
+
+    data = json.loads(json.dumps(response.data, default=str))
+    IdempotencyKey.objects.filter(key=key).update(
+        status_code=response.status_code, response=json.dumps(data))
+    cache.set(f'idempotency:{key}', {
+        'fingerprint': fingerprint,
+        'status_code': response.status_code,
+        'data': data,
+        'created_at': timezone.now(),
+    }, settings.IDEMPOTENCY_TTL)
+    return response
+
+
+def _clock():
+    # Clock of the token buckets. Wall clock: the stamps are compared across
+    # processes, time.monotonic() is per process.
+    return time.time()
+
+
+def _cache_key(*parts):
+    # Product ids and the like are user input, not valid memcached keys.
+    return hashlib.md5(':'.join(str(part) for part in parts).encode()
+                       ).hexdigest()
+
+
+class TokenBucket(object):
+    '''
+    Token bucket shared by all the uwsgi workers through the cache: up to
+    `capacity` tokens, refilled continuously at `rate` tokens per second.
+    The bucket is stored as (tokens, timestamp) and updated with memcached
+    gets/cas, a writer that lost the race re-reads and tries again.
+
+    Backends without cas (locmem in development) fall back to get/set, which
+    is not atomic across processes.
+    '''
+
+    MAX_RETRIES = 5
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        # A bucket untouched that long is full again, no need to keep it.
+        self.timeout = math.ceil(capacity / rate) + 1
+
+    def take(self, key):
+        '''
+        :return: 0 if a token was taken, else the seconds until the next one
+        '''
+        cache_key = _cache_key('bucket', self.name, key)
+        client = getattr(cache, '_cache', None)
+        if getattr(client, 'cache_cas', False):
+            # The client skips Django's key prefixing and versioning.
+            cache_key = cache.make_key(cache_key)
+        else:
+            client = None
+
+        for _ in range(self.MAX_RETRIES):
+            now = _clock()
+            state = client.gets(cache_key) if client else cache.get(cache_key)
+            if state is None:
+                tokens = self.capacity
+            else:
+                tokens, stamp = state
+                tokens = min(self.capacity,
+                             tokens + (now - stamp) * self.rate)
+
+            if tokens < 1:
+                if client:
+                    client.reset_cas()
+                return (1 - tokens) / self.rate
+
+            new_state = (tokens - 1, now)
+            if client is None:
+                cache.set(cache_key, new_state, self.timeout)
+                return 0
+            if state is None:
+                stored = client.add(cache_key, new_state, self.timeout)
+            else:
+                stored = client.cas(cache_key, new_state, self.timeout)
+                client.reset_cas()
+            if stored:
+                return 0
+
+        # Lost every race: the key is that busy, shed this one.
+        return 1 / self.rate
+
+
+class ConcurrencyLimit(object):
+    '''
+    At most `limit` in-flight requests across the uwsgi workers, as `limit`
+    slot keys in the cache. Each slot expires on its own after `timeout`
+    seconds, so a slot leaked by a killed worker comes back even under
+    load. Requests running longer than that lose their slot early.
+    '''
+
+    def __init__(self, name, limit, timeout=60):
+        self.keys = [_cache_key('in_flight', name, slot)
+                     for slot in range(limit)]
+        self.timeout = timeout
+        self.slot = None
+        self.token = None
+
+    def acquire(self):
+        taken = cache.get_many(self.keys)
+        free = [key for key in self.keys if key not in taken]
+        random.shuffle(free)
+        token = uuid.uuid4().hex
+        for key in free:
+            if cache.add(key, token, timeout=self.timeout):
+                self.slot, self.token = key, token
+                return True
+        return False
+
+    def release(self):
+        if self.slot is None:
+            return
+        # Expired and taken by another request meanwhile: not ours to free.
+        if cache.get(self.slot) == self.token:
+            cache.delete(self.slot)
+        self.slot = self.token = None
+
+
+def _shed(status, retry_after, message):
+    return Response({constants.NOT_OK: message}, status=status,
+                    headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+def admission_control(function):
+    '''
+    Shed order creation load before it reaches the database: per customer and
+    per product token buckets (429) and a global limit on in-flight stock
+    transactions (503), both answered at once with Retry-After. The limits
+    come from settings.ORDER_ADMISSION.
+    '''
+    @wraps(function)
+    def wrap(*args, **kwargs):
+        request = _get_request(args)
+        conf = settings.ORDER_ADMISSION
+
+        customer = request.user.pk or request.META.get('REMOTE_ADDR')
+        retry_after = TokenBucket(
+            'customer', conf['CUSTOMER_RATE'], conf['CUSTOMER_BURST']
+        ).take(customer)
+
+        product_id = request.data.get('product_id')
+        if not retry_after and product_id:
+            retry_after = TokenBucket(
+                'product', conf['PRODUCT_RATE'], conf['PRODUCT_BURST']
+            ).take(product_id)
+
+        if retry_after:
+            return _shed(429, retry_after, 'too many orders, retry later')
+
+        in_flight = ConcurrencyLimit('order_create', conf['MAX_IN_FLIGHT'])
+        if not in_flight.acquire():
+            return _shed(503, conf['RETRY_AFTER'], 'server busy, retry later')
+        try:
+            return function(*args, **kwargs)
+        finally:
+            in_flight.release()
+
+    return wrap
@@ -1,20 +1,79 @@
-from django.db.models import Sum, Q
+import io
+
+from django.core.cache import cache
+from django.db.models import Sum
 from django.http import JsonResponse
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from rest_framework import mixins, viewsets, renderers
 
-from shopper.utils import vip_required, check_stock
-from shopper.models import Order, Product
+from shopper.utils import vip_required, check_stock, idempotent, \
+    admission_control
+from mysite.libs import constants
+from shopper.models import Order, Product, bulk_cancel_orders
 from shopper.serializer import OrderSerializer, ProductSerializer
+from shopper.tasks import bulk_cancel_orders_task, \
+    backfill_restocked_products, TOP_PRODUCTS_CACHE_KEY, TOP_PRODUCTS_COUNT
+from shopper.catalog import import_catalog, guess_format, CatalogError
+
+# Bigger batches are cancelled by a celery task instead of in the request.
+BULK_CANCEL_SYNC_LIMIT = 500
+
+
+def filter_orders(queryset, params):
+    '''
+    Filters of the order list, each combination is backed by an index on
+    shopper_order (see Order.Meta.indexes):
+
+        shop_id, status (comma separated), product_id,
+        created_after / created_before (ISO 8601)
+    '''
+    shop_id = params.get('shop_id')
+    if shop_id:
+        queryset = queryset.filter(shop_id=shop_id)
+
+    status = params.get('status')
+    if status:
+        try:
+            statuses = sorted({int(val) for val in status.split(',')})
+        except ValueError:
+            raise ValidationError({'status': 'comma separated integers'})
+        queryset = queryset.filter(status__in=statuses)
+
+    product_id = params.get('product_id')
+    if product_id:
+        # Resolve the pk first, so the filter hits the (product, created_at)
+        # index instead of joining shopper_product.
+        product_pk = Product.objects.filter(product_id=product_id
+            ).values_list('id', flat=True).first()
+        queryset = queryset.filter(product_id=product_pk)
+
+    for param, lookup in (('created_after', 'created_at__gte'),
+                          ('created_before', 'created_at__lt')):
+        value = params.get(param)
+        if value:
+            try:
+                created_at = parse_datetime(value)
+            except ValueError:
+                # Well formed but not a date, e.g. month 13.
+                created_at = None
+            if created_at is None:
+                raise ValidationError({param: 'ISO 8601 datetime'})
+            queryset = queryset.filter(**{lookup: created_at})
+
+    return queryset
 
 
 
 class ProductViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     model = Product
+    queryset = Product.objects.order_by('product_id')
     serializer_class = ProductSerializer
-    renderer_classes = renderers.JSONRenderer
+    renderer_classes = [renderers.JSONRenderer]
 
 
 class OrderViewSet(mixins.CreateModelMixin,
@@ -28,7 +87,7 @@ class OrderViewSet(mixins.CreateModelMixin,
 
     model = Order
     serializer_class = OrderSerializer
-    renderer_classes = renderers.JSONRenderer
+    renderer_classes = [renderers.JSONRenderer]
 
     def get_queryset(self):
 
@@ -43,7 +102,7 @@ class OrderViewSet(mixins.CreateModelMixin,
 
     # TODO: add cache_response decorator
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
+        queryset = filter_orders(self.get_queryset(), request.query_params)
 
         paginated_queryset = self.paginate_queryset(queryset)
         if paginated_queryset is not None:
@@ -55,15 +114,19 @@ class OrderViewSet(mixins.CreateModelMixin,
         data = {'orders': serializer.data}
         return Response(data)
 
+    # Retries with the same Idempotency-Key are replayed before the stock and
+    # vip checks run again. Replays do not count against the admission limits.
+    @idempotent
+    @admission_control
     @check_stock
     @vip_required
     def create(self, request, *args, **kwargs):
-        ret = super().create(self, request, *args, **kwargs)
+        ret = super().create(request, *args, **kwargs)
         return ret
 
     # To cancel an order, we use update() but not destroy().
     def update(self, request, *args, **kwargs):
-        return super().update(self, request, *args, **kwargs)
+        return super().update(request, *args, **kwargs)
 
 
 @csrf_exempt
@@ -73,16 +136,15 @@ def get_top_3_products(request):
     '''
     Based on the total qty in orders to calculate the 3 most hot products.
     '''
-    top_count = 3
-
-    # Status in Fail and Cancel should be excluded.
-    hot_products = list(
-        Order.objects.filter(
-            order_status__in=[Order.SUCCESS, Order.PAYMENT_PENDING, Order.NOT_IN_STOCK]
-        ).values('product').annotate(total_qty=Sum('qty')
-        ).values_list('product__id', flat=True
-        ).order_by('-total_qty')[:top_count]
-    )
+    # Computed from the order snapshot by the refresh_top_products task.
+    hot_products = cache.get(TOP_PRODUCTS_CACHE_KEY)
+    if hot_products is None:
+        hot_products = list(
+            Order.objects.filter(status__in=Order.ACTIVE_STATUSES
+            ).values('product').annotate(total_qty=Sum('qty')
+            ).order_by('-total_qty'
+            ).values_list('product', flat=True)[:TOP_PRODUCTS_COUNT]
+        )
     response = []
     for rank, product_id in enumerate(hot_products):
 
@@ -92,4 +154,57 @@ def get_top_3_products(request):
                 'product_id': product_id
             }
         )
-    return JsonResponse(response, status=200)
+    return JsonResponse(response, status=200, safe=False)
+
+
+@csrf_exempt
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+@idempotent
+def bulk_cancel(request):
+    '''
+    Cancel a batch of orders, e.g. on fraud or payment failure.
+    Body: {"order_ids": [...], "shop_id": optional}
+    '''
+    order_ids = request.data.get('order_ids')
+    shop_id = request.data.get('shop_id')
+    if not isinstance(order_ids, list) or not order_ids:
+        res = {constants.NOT_OK: 'order_ids should be a non-empty list'}
+        return Response(res, status=400)
+
+    if len(order_ids) > BULK_CANCEL_SYNC_LIMIT:
+        result = bulk_cancel_orders_task.delay(order_ids, shop_id=shop_id)
+        return Response({constants.ALL_OK: {'task_id': result.id}},
+                        status=202)
+
+    cancelled = bulk_cancel_orders(order_ids, shop_id=shop_id)
+    return Response({constants.ALL_OK: {'cancelled': cancelled}})
+
+
+@csrf_exempt
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def import_products(request):
+    '''
+    Bulk upsert products from an uploaded CSV/NDJSON catalog (multipart
+    "file", optional "format"). The restock backfill runs in celery.
+    '''
+    upload = request.FILES.get('file')
+    if upload is None:
+        res = {constants.NOT_OK: 'file is required'}
+        return Response(res, status=400)
+
+    fmt = request.data.get('format') or guess_format(upload.name)
+    try:
+        result = import_catalog(
+            io.TextIOWrapper(upload.file, encoding='utf-8', newline=''), fmt)
+    except CatalogError as e:
+        return Response({constants.NOT_OK: str(e)}, status=400)
+
+    if result['restocked']:
+        backfill_restocked_products.delay(result['restocked'])
+
+    return Response({constants.ALL_OK: {
+        'rows': result['rows'],
+        'restocked': len(result['restocked']),
+    }})